@@ -4,9 +4,14 @@ import dash
 from dash import html, Input, Output, State, ctx, no_update, dcc
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-from layout import (title, same_setting, plots, make_plot, adjust_date_range,get_obsnum_range,create_index_files,make_compare_plot)
+from layout import (title, create_same_setting, create_plots, get_plot, adjust_date_range,get_obsnum_range,get_compare_plot,
+                    fetch_data, utc_now, get_summary_table)
+import config
+import ingest
+import metrics
+from plotting import relayout_x_range
 import flask
-from datetime import timedelta, datetime
+from datetime import timedelta
 
 prefix = '/lmtqldb/'
 
@@ -20,13 +25,39 @@ app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP,
                 prevent_initial_callbacks="initial_duplicate", suppress_callback_exceptions=True
                 )
 
-app.layout = html.Div([
+# New data files are indexed by a background worker, never on the request path
+@server.before_request
+def start_ingest_worker():
+    if config.ingest_in_process:
+        ingest.start_worker()
 
-    html.Div(title),
-    html.Div(id = 'same-setting', children=same_setting),
-    html.Div(plots),
-    dcc.Interval(id = 'interval-component', interval = 1000 * 60 * 60 * 24, n_intervals = 0)
-    ])
+# Stage timings, file counters and cache statistics for Prometheus
+@server.route(prefix + 'metrics')
+def serve_metrics():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# The layout is built on the first page load rather than at import, from the in-memory
+# catalog of dates and receivers, and rebuilt when new data arrived or the day changed
+layout_cache = {'key': None, 'layout': None}
+
+
+def serve_layout():
+    key = (ingest.current_generation(), utc_now().date())
+    if layout_cache['key'] != key:
+        layout_cache['layout'] = html.Div([
+
+            html.Div(title),
+            html.Div(id = 'same-setting', children=create_same_setting()),
+            html.Div(create_plots()),
+            # Settings of the data loaded by update_same_data, used as its server side key
+            dcc.Store(id='same-data'),
+            dcc.Interval(id = 'interval-component', interval = 1000 * 60 * 60 * 24, n_intervals = 0)
+            ])
+        layout_cache['key'] = key
+    return layout_cache['layout']
+
+
+app.layout = serve_layout
 
 @app.callback(
     Output('same-date-picker-range', 'start_date',allow_duplicate=True),
@@ -34,10 +65,8 @@ app.layout = html.Div([
     Input('interval-component', 'n_intervals'),
 )
 def update_start_date(n):
-
-    create_index_files()
-    start_date = datetime.now() - timedelta(days=7)
-    end_date = datetime.now()
+    start_date = utc_now() - timedelta(days=7)
+    end_date = utc_now()
     return start_date, end_date
 # update date range for same setting
 @app.callback(
@@ -66,25 +95,56 @@ def update_same_date(prev_week, next_week, prev_month, next_month, prev_year, ne
     Input('same-date-picker-range', 'start_date'),
     Input('same-date-picker-range', 'end_date'),
 )
+@metrics.timed_callback
 def update_same_obsnum_range(start_date, end_date):
     return get_obsnum_range('same',start_date, end_date)
 
 
-# Callback for updating astig-plot
+# Load the data of all three plots once per settings change
 @app.callback(
-    Output('astig-plot', 'figure'),
-    Input('same-x-axis', 'value'),
-    Input('astig-y-axis', 'value'),
+    Output('same-data', 'data'),
     Input('same-date-picker-range', 'start_date'),
     Input('same-date-picker-range', 'end_date'),
     Input('same-obsnum-start', 'value'),
     Input('same-obsnum-end', 'value'),
     Input('same-receiver', 'value'),
 )
-def update_astig_plot(x_axis, astig_y_axis, start_date, end_date, obsnum_start, obsnum_end, receivers):
+@metrics.timed_callback
+def update_same_data(start_date, end_date, obsnum_start, obsnum_end, receivers):
+    try:
+        return fetch_data(start_date, end_date, obsnum_start, obsnum_end, receivers)
+    except Exception as e:
+        metrics.record_error('update_same_data', e)
+        return no_update
+
+def get_x_range(plot_id, relayout_data):
+    # A settings change draws the whole range as a coarse overview, a zoom on the plot
+    # itself re-queries only the visible x window at full resolution
+    if ctx.triggered_id != plot_id:
+        return None
+    changed, x_range = relayout_x_range(relayout_data)
+    if not changed:
+        raise PreventUpdate
+    return x_range
+
+# Callback for updating astig-plot
+@app.callback(
+    Output('astig-plot', 'figure'),
+    Input('same-x-axis', 'value'),
+    Input('astig-y-axis', 'value'),
+    Input('same-data', 'data'),
+    Input('astig-plot', 'relayoutData'),
+)
+@metrics.timed_callback
+def update_astig_plot(x_axis, astig_y_axis, settings, relayout_data):
+    if settings is None:
+        raise PreventUpdate
+    x_range = get_x_range('astig-plot', relayout_data)
     try:
-        return make_plot('astig', start_date, end_date, obsnum_start, obsnum_end, receivers, x_axis, astig_y_axis)
+        return get_plot('astig', settings['date_start'], settings['date_end'], settings['obsnum_start'],
+                        settings['obsnum_end'], settings['receivers'], x_axis, astig_y_axis, x_range)
     except Exception as e:
+        metrics.record_error('update_astig_plot', e)
         return no_update
 
 # Callback for updating focus-plot
@@ -92,16 +152,19 @@ def update_astig_plot(x_axis, astig_y_axis, start_date, end_date, obsnum_start,
     Output('focus-plot', 'figure'),
     Input('same-x-axis', 'value'),
     Input('focus-y-axis', 'value'),
-    Input('same-date-picker-range', 'start_date'),
-    Input('same-date-picker-range', 'end_date'),
-    Input('same-obsnum-start', 'value'),
-    Input('same-obsnum-end', 'value'),
-    Input('same-receiver', 'value'),
+    Input('same-data', 'data'),
+    Input('focus-plot', 'relayoutData'),
 )
-def update_focus_plot(x_axis, focus_y_axis, start_date, end_date, obsnum_start, obsnum_end, receivers):
+@metrics.timed_callback
+def update_focus_plot(x_axis, focus_y_axis, settings, relayout_data):
+    if settings is None:
+        raise PreventUpdate
+    x_range = get_x_range('focus-plot', relayout_data)
     try:
-        return make_plot('focus', start_date, end_date, obsnum_start, obsnum_end, receivers, x_axis, focus_y_axis)
+        return get_plot('focus', settings['date_start'], settings['date_end'], settings['obsnum_start'],
+                        settings['obsnum_end'], settings['receivers'], x_axis, focus_y_axis, x_range)
     except Exception as e:
+        metrics.record_error('update_focus_plot', e)
         return no_update
 
 # Callback for updating pointing-plot
@@ -109,16 +172,19 @@ def update_focus_plot(x_axis, focus_y_axis, start_date, end_date, obsnum_start,
     Output('pointing-plot', 'figure'),
     Input('same-x-axis', 'value'),
     Input('pointing-y-axis', 'value'),
-    Input('same-date-picker-range', 'start_date'),
-    Input('same-date-picker-range', 'end_date'),
-    Input('same-obsnum-start', 'value'),
-    Input('same-obsnum-end', 'value'),
-    Input('same-receiver', 'value'),
+    Input('same-data', 'data'),
+    Input('pointing-plot', 'relayoutData'),
 )
-def update_pointing_plot(x_axis, pointing_y_axis, start_date, end_date, obsnum_start, obsnum_end, receivers):
+@metrics.timed_callback
+def update_pointing_plot(x_axis, pointing_y_axis, settings, relayout_data):
+    if settings is None:
+        raise PreventUpdate
+    x_range = get_x_range('pointing-plot', relayout_data)
     try:
-        return make_plot('pointing', start_date, end_date, obsnum_start, obsnum_end, receivers, x_axis, pointing_y_axis)
+        return get_plot('pointing', settings['date_start'], settings['date_end'], settings['obsnum_start'],
+                        settings['obsnum_end'], settings['receivers'], x_axis, pointing_y_axis, x_range)
     except Exception as e:
+        metrics.record_error('update_pointing_plot', e)
         return no_update
 
 def create_toggle_and_update_modal_callback(modal_type):
@@ -156,6 +222,7 @@ def create_obsnum_range_callback(modal_type):
         Input(f'{modal_type}-multi-date-picker', 'value'),
         prevent_initial_call=True
     )
+    @metrics.timed_callback(name=f'{modal_type}_update_obsnum_range')
     def update_obsnum_range(dates):
         if dates is None:
             raise PreventUpdate
@@ -186,20 +253,42 @@ def create_update_plot1_callback(modal_type):
         ],
         prevent_initial_call=True
     )
+    @metrics.timed_callback(name=f'{modal_type}_update_plot1')
     def update_plot1(dates, obsnum_start, obsnum_end, receivers,  y_axis):
         try:
             if None in [dates, obsnum_start, obsnum_end, receivers, y_axis]:
                 print("One or more inputs are None, skipping plot update.")
                 return {}
-            fig1 = make_compare_plot(modal_type, dates, obsnum_start, obsnum_end, receivers, y_axis)
+            fig1 = get_compare_plot(modal_type, dates, obsnum_start, obsnum_end, receivers, y_axis)
             return fig1
         except Exception as e:
-            print(f"Error generating plots: {e}")
+            metrics.record_error(f'{modal_type} update_plot1', e)
             return {}
 
     return update_plot1
 
 
+def create_stats_callback(modal_type):
+    # Statistics panel under the plot, for its selected y-axis fields
+    @app.callback(
+        Output(f'{modal_type}-stats', 'children'),
+        Input(f'{modal_type}-y-axis', 'value'),
+        Input('same-data', 'data'),
+    )
+    @metrics.timed_callback(name=f'{modal_type}_update_stats')
+    def update_stats(y_axis, settings):
+        if settings is None:
+            raise PreventUpdate
+        try:
+            return get_summary_table(modal_type, settings['date_start'], settings['date_end'],
+                                     settings['obsnum_start'], settings['obsnum_end'], settings['receivers'],
+                                     y_axis)
+        except Exception as e:
+            metrics.record_error(f'{modal_type} update_stats', e)
+            return no_update
+
+    return update_stats
+
 
 # Create callbacks for each type
 toggle_and_update_astig = create_toggle_and_update_modal_callback('astig')
@@ -214,6 +303,10 @@ toggle_and_update_pointing = create_toggle_and_update_modal_callback('pointing')
 update_pointing_plot1 = create_update_plot1_callback('pointing')
 update_pointing_obsnum_range = create_obsnum_range_callback('pointing')
 
+update_astig_stats = create_stats_callback('astig')
+update_focus_stats = create_stats_callback('focus')
+update_pointing_stats = create_stats_callback('pointing')
+
 
 if __name__ == '__main__':
     app.run_server(debug=False)
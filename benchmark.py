@@ -0,0 +1,271 @@
+# Benchmark of the data path on a synthetic data tree.
+#   python benchmark.py generate /tmp/lmtqldb_bench --days 400 --rows 300
+#   python benchmark.py run /tmp/lmtqldb_bench --label my-change
+#   python benchmark.py compare
+# generate writes cleaned astigmatism/focus/pointing and raw tel CSVs named like the real
+# ones, run times the entry points and the Dash callbacks for week, month and year
+# ranges and appends the results to benchmark_results.jsonl, compare prints the runs
+# side by side.
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import config
+
+receiver_weights = {
+    'Sequoia': 0.3,
+    'Toltec': 0.2,
+    'RedshiftReceiver': 0.15,
+    'Msip1mm': 0.15,
+    'Muscat': 0.1,
+    'B4r': 0.05,
+    'AztecReceiver': 0.05,
+}
+astig_fields = ['M1ZC0']
+focus_fields = ['M2XOffset', 'M2YOffset', 'M2ZOffset']
+pointing_fields = [
+    'AzPointOffset', 'ElPointOffset', 'Flag', 'FitFlag', 'FitRegion', 'PeakValue', 'PeakError', 'AzMapOffset',
+    'ElMapOffset', 'AzMapOffsetError', 'ElMapOffsetError', 'AzHpbw', 'ElHpbw', 'AzHpbwError', 'ElHpbwError',
+    'PeakSnrValue', 'PeakSnrError'
+]
+# Columns of the raw tel files besides the ones the app reads
+tel_extra_columns = [f'Telescope_{name}' for name in [
+    'AzActPos', 'ElActPos', 'AzCmdPos', 'ElCmdPos', 'AzPcor', 'ElPcor', 'AzUserOff', 'ElUserOff',
+    'Temperature', 'Humidity', 'Pressure', 'WindSpeed', 'WindDir', 'Tau']]
+results_filename = 'benchmark_results.jsonl'
+
+
+def data_dirs(root):
+    return os.path.join(root, 'cleaned_data'), os.path.join(root, 'raw_data')
+
+
+def generate(root, days, rows, end_date=None, seed=0):
+    # days daily files per folder, each with up to rows rows. Observations are shared by
+    # the folders as on the telescope: every observation has tel rows, most a pointing
+    # fit, some astigmatism and focus values
+    clean, raw = data_dirs(root)
+    folders = config.data_folders(clean, raw)
+    for folder_path in folders.values():
+        os.makedirs(folder_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    end_date = pd.Timestamp(end_date or datetime.date.today()).normalize()
+    receivers = np.array(list(receiver_weights))
+    weights = np.array(list(receiver_weights.values()))
+    obsnum = 100000
+    for day in pd.date_range(end=end_date, periods=days, freq='D'):
+        date_str = day.strftime('%Y-%m-%d')
+        seconds = np.sort(rng.uniform(0, 86400, rows)).astype(int)
+        obs = pd.DataFrame({
+            'Date': date_str,
+            'Time': pd.to_datetime(seconds, unit='s').strftime('%H:%M:%S'),
+            'ObsNum': np.arange(obsnum, obsnum + rows),
+            'Receiver': rng.choice(receivers, rows, p=weights),
+        })
+        obsnum += rows + int(rng.integers(0, 50))
+
+        astig = obs[rng.random(rows) < 0.4].copy()
+        astig['M1ZC0'] = rng.normal(0, 80, len(astig)).round(2)
+        focus = obs[rng.random(rows) < 0.6].copy()
+        for field, scale in zip(focus_fields, [0.5, 0.5, 1.5]):
+            focus[field] = rng.normal(0, scale, len(focus)).round(4)
+        pointing = obs[rng.random(rows) < 0.9].copy()
+        for field in pointing_fields:
+            if field in ['Flag', 'FitFlag', 'FitRegion']:
+                pointing[field] = rng.integers(0, 3, len(pointing))
+            else:
+                pointing[field] = rng.normal(0, 3, len(pointing)).round(3)
+        pointing['PixelList'] = '[0, 1, 2, 3]'
+
+        # A few tel rows per observation, positions in radians as in the raw files
+        repeats = rng.integers(2, 6, rows)
+        tel = obs.loc[obs.index.repeat(repeats)].reset_index(drop=True)
+        tel['Telescope_AzDesPos'] = np.repeat(rng.uniform(-1.5, 6.0, rows), repeats).round(6)
+        tel['Telescope_ElDesPos'] = np.repeat(rng.uniform(0.3, 1.5, rows), repeats).round(6)
+        for column in tel_extra_columns:
+            tel[column] = rng.normal(0, 1, len(tel)).round(5)
+
+        astig.to_csv(os.path.join(folders['astigmatism'], f'astigmatism_cleaned_{date_str}.csv'), index=False)
+        focus.to_csv(os.path.join(folders['focus'], f'focus_cleaned_{date_str}.csv'), index=False)
+        pointing.to_csv(os.path.join(folders['pointing'], f'pointing_cleaned_{date_str}.csv'), index=False)
+        tel.to_csv(os.path.join(folders['tel'], f'tel_{date_str}.csv'), index=False)
+
+
+def timeit(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+
+def callback_request(output, inputs, changed):
+    outputs = [dict(zip(['id', 'property'], item.split('.'))) for item in output.split('...')]
+    return {
+        'output': output,
+        'outputs': outputs[0] if len(outputs) == 1 else outputs,
+        'inputs': [{'id': id, 'property': prop, 'value': value} for id, prop, value in inputs],
+        'changedPropIds': changed,
+        'state': [],
+    }
+
+
+def run(root, repeat, backend):
+    config.set_data_dirs(*data_dirs(root))
+    config.ingest_in_process = False
+    config.storage_backend = backend
+    import ingest
+    # The first ingest of a tree also writes the sidecars and fills the SQLite store
+    results = {'ingest': timeit(ingest.run_once, 1)}
+
+    import layout
+    import app
+    client = app.server.test_client()
+    url = f'{app.prefix}_dash-update-component'
+
+    def callback(output, inputs, changed):
+        response = client.post(url, json=callback_request(output, inputs, changed))
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f'{output} returned {response.status_code}')
+        return response.get_json() if response.status_code == 200 else None
+
+    dates = layout.get_dates('pointing')
+    if not dates:
+        raise SystemExit(f'No data found under {root}, run generate first')
+    end_date = pd.Timestamp(dates[0])
+    receivers = list(receiver_weights)
+    for range_name, offset in [('week', pd.DateOffset(weeks=1)), ('month', pd.DateOffset(months=1)),
+                               ('year', pd.DateOffset(years=1))]:
+        start_date = end_date - offset
+        obsnum_start, obsnum_end = layout.get_obsnum_range('same', start_date, end_date)
+
+        def clear_caches():
+            layout.df_cache.clear()
+            layout.figure_cache.clear()
+
+        def timed(name, fn, cold=False):
+            setup = clear_caches if cold else None
+            results[f'{name}/{range_name}'] = timeit(fn, repeat, setup)
+
+        timed('load_data', lambda: layout.load_data(
+            config.folder_paths['pointing'], start_date, end_date))
+        timed('get_df cold', lambda: layout.get_df('pointing', start_date, end_date), cold=True)
+        timed('get_df warm', lambda: layout.get_df('pointing', start_date, end_date))
+        timed('get_obsnum_range', lambda: layout.get_obsnum_range('same', start_date, end_date))
+        timed('make_plot', lambda: layout.make_plot(
+            'pointing', start_date, end_date, obsnum_start, obsnum_end, receivers, 'ObsNum',
+            ['AzPointOffset', 'ElPointOffset']))
+        timed('make_plot time axis', lambda: layout.make_plot(
+            'focus', start_date, end_date, obsnum_start, obsnum_end, receivers, 'Time', focus_fields))
+        compare_dates = [date for date in dates if start_date <= pd.Timestamp(date) <= end_date][:7]
+        timed('make_compare_plot', lambda: layout.make_compare_plot(
+            'focus', compare_dates, obsnum_start, obsnum_end, receivers, ['M2ZOffset']), cold=True)
+
+        # The whole chain of callbacks a date change triggers in the browser
+        settings_inputs = [
+            ('same-date-picker-range', 'start_date', start_date.isoformat()),
+            ('same-date-picker-range', 'end_date', end_date.isoformat()),
+            ('same-obsnum-start', 'value', obsnum_start),
+            ('same-obsnum-end', 'value', obsnum_end),
+            ('same-receiver', 'value', receivers),
+        ]
+
+        def date_change():
+            settings = callback('same-data.data', settings_inputs, ['same-date-picker-range.start_date'])
+            settings = settings['response']['same-data']['data']
+            for name, fields in [('astig', astig_fields), ('focus', focus_fields[2:]),
+                                 ('pointing', pointing_fields[:2])]:
+                callback(f'{name}-plot.figure', [
+                    ('same-x-axis', 'value', 'ObsNum'),
+                    (f'{name}-y-axis', 'value', fields),
+                    ('same-data', 'data', settings),
+                    (f'{name}-plot', 'relayoutData', None),
+                ], ['same-data.data'])
+
+        timed('callbacks cold', date_change, cold=True)
+        timed('callbacks warm', date_change)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record(results_path, label, root, repeat, backend, results):
+    entry = {
+        'label': label,
+        'revision': revision(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'data': root,
+        'files': len(os.listdir(config.data_folders(*data_dirs(root))['pointing'])),
+        'backend': backend,
+        'repeat': repeat,
+        'results': results,
+    }
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def compare(results_path, last):
+    with open(results_path) as f:
+        entries = [json.loads(line) for line in f if line.strip()][-last:]
+    names = []
+    for entry in entries:
+        names += [name for name in entry['results'] if name not in names]
+    headers = [entry['label'] or entry['revision'] or entry['time'] for entry in entries]
+    width = max(len(name) for name in names)
+    print(' ' * width + ''.join(f'{header[:14]:>16}' for header in headers))
+    for name in names:
+        cells = ''
+        for entry in entries:
+            value = entry['results'].get(name)
+            cells += f"{value['median'] * 1000:14.1f}ms" if value else f'{"-":>16}'
+        print(f'{name:<{width}}{cells}')
+
+
+def print_results(results):
+    width = max(len(name) for name in results)
+    for name, value in results.items():
+        print(f"{name:<{width}}  median {value['median'] * 1000:10.1f}ms  min {value['min'] * 1000:10.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the LMT QL DB data path on synthetic data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate_parser = commands.add_parser('generate', help='write a synthetic data tree')
+    generate_parser.add_argument('root')
+    generate_parser.add_argument('--days', type=int, default=400)
+    generate_parser.add_argument('--rows', type=int, default=300, help='observations per day')
+    generate_parser.add_argument('--end-date', help='last day of data, default today')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    run_parser = commands.add_parser('run', help='time the entry points on a generated tree')
+    run_parser.add_argument('root')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    run_parser.add_argument('--label', default='')
+    run_parser.add_argument('--results', default=results_filename)
+    compare_parser = commands.add_parser('compare', help='print recorded runs side by side')
+    compare_parser.add_argument('--results', default=results_filename)
+    compare_parser.add_argument('--last', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.root, args.days, args.rows, args.end_date, args.seed)
+    elif args.command == 'run':
+        results = run(args.root, args.repeat, args.backend)
+        record(args.results, args.label, args.root, args.repeat, args.backend, results)
+        print_results(results)
+    else:
+        compare(args.results, args.last)
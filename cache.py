@@ -0,0 +1,178 @@
+# In-process caches of loaded DataFrames and built figures, bounded by their memory footprint.
+# With a shared store (see sharedcache.py) a miss is looked up there before it is built,
+# and what is built is put there for the other processes
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    import pyarrow as pa
+    has_arrow = True
+except ImportError:
+    has_arrow = False
+
+
+class DataFrameCache:
+    namespace = 'df'
+
+    def __init__(self, max_bytes, shared=None):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared = shared
+        self.shared_hits = 0
+        self.generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Per key locks of the entries being built, see get_or_build()
+        self._building = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_or_build(self, key, build):
+        # Concurrent callers of the same missing key wait for a single build(),
+        # so one settings change does not load and merge the same files twice
+        df = self.get(key)
+        if df is not None:
+            return df
+        with self._lock:
+            key_lock = self._building.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                with self._lock:
+                    entry = self._entries.get(key)
+                if entry is not None:
+                    return entry[0]
+                generation = self.generation
+                df = self.load_or_build(key, build)
+                # Built from data older than the generation set meanwhile, not kept
+                if self.generation == generation:
+                    self.put(key, df)
+                return df
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    self._building.pop(key, None)
+
+    def sizeof(self, df):
+        return int(df.memory_usage(index=True, deep=True).sum())
+
+    def set_generation(self, generation):
+        # New data makes every entry stale, in memory and in the shared store
+        if generation == self.generation:
+            return
+        self.clear()
+        self.generation = generation
+        if self.shared is not None:
+            self.shared.set_generation(generation)
+
+    def shared_key(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f'{self.generation}-{self.namespace}-{digest}'
+
+    def load_or_build(self, key, build):
+        # DataFrames are shared as Arrow IPC streams
+        if self.shared is None or not has_arrow:
+            return build()
+        shared_key = self.shared_key(key)
+        data = self.shared.get(shared_key)
+        if data is not None:
+            try:
+                df = pa.ipc.open_stream(data).read_all().to_pandas()
+                self.shared_hits += 1
+                return df
+            except Exception as e:
+                print(f"Error reading shared cache entry {shared_key}: {e}")
+        df = build()
+        table = pa.Table.from_pandas(df)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        self.shared.put(shared_key, sink.getvalue())
+        return df
+
+    def put(self, key, df):
+        nbytes = self.sizeof(df)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (df, nbytes)
+            self.total_bytes += nbytes
+            # Evict least recently used entries until the cache fits again
+            while self.total_bytes > self.max_bytes:
+                _, (_, old_bytes) = self._entries.popitem(last=False)
+                self.total_bytes -= old_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'shared_hits': self.shared_hits,
+            }
+
+
+class FigureCache(DataFrameCache):
+    # Figures by the normalized inputs of the plot that built them, kept as the plain
+    # dict of their JSON so that a hit needs neither pandas nor plotly. The JSON text is
+    # what goes to the shared store. Entries belong to one ingest generation
+    namespace = 'figure'
+
+    def sizeof(self, entry):
+        return entry[0]
+
+    def get_figure(self, key, build):
+        # build() returns a figure dict or go.Figure, only called when no tier has the key
+        key = (self.generation,) + tuple(key)
+        return self.get_or_build(key, build)[1]
+
+    def serialize(self, figure):
+        # (JSON text, dict) of a built figure, a figure dict as is or a go.Figure
+        if isinstance(figure, dict):
+            return json.dumps(figure), figure
+        text = figure.to_json()
+        return text, json.loads(text)
+
+    def load_or_build(self, key, build):
+        # Figures are shared as their JSON text
+        if self.shared is None:
+            text, figure = self.serialize(build())
+            return len(text), figure
+        shared_key = self.shared_key(key)
+        data = self.shared.get(shared_key)
+        if data is not None:
+            try:
+                figure = json.loads(data)
+                self.shared_hits += 1
+                return len(data), figure
+            except Exception as e:
+                print(f"Error reading shared cache entry {shared_key}: {e}")
+        text, figure = self.serialize(build())
+        self.shared.put(shared_key, text.encode())
+        return len(text), figure
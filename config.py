@@ -0,0 +1,119 @@
+# Define data locations and tunables shared by the app modules
+import os
+
+clean_base_dir = '/home/lmtmc/lmtqldb/cleaned_data'
+raw_base_dir = '/raw/lmtqldb'
+#
+# clean_base_dir = '/home/lmt/raw_data/lmtqldb/cleaned_data'
+# raw_base_dir = '/home/lmt/raw_data/lmtqldb/raw_data'
+index_dir = os.path.join(clean_base_dir, 'index')
+
+
+def data_folders(clean_base_dir, raw_base_dir):
+    return {
+        'astigmatism': f'{clean_base_dir}/astigmatism_cleaned',
+        'focus': f'{clean_base_dir}/focus_cleaned',
+        'pointing': f'{clean_base_dir}/pointing_cleaned',
+        'tel': f'{raw_base_dir}/tel',
+    }
+
+
+folder_paths = data_folders(clean_base_dir, raw_base_dir)
+
+# Columnar sidecar copies of the daily CSVs, one sub folder per folder_paths key
+cache_dir = os.path.join(clean_base_dir, 'cache')
+use_sidecar_cache = True
+
+# Tel files are parsed in blocks of this many bytes, keeping only the columns of the
+# telescope lookup. A tel file that grew is only read from where the last read stopped
+tel_block_bytes = 16 * 1024 * 1024
+
+# Upper bound on the memory held by cached get_df results
+df_cache_max_bytes = 512 * 1024 * 1024
+# Upper bound on the memory held by cached figures
+figure_cache_max_bytes = 128 * 1024 * 1024
+# Cache shared by all app processes (e.g. gunicorn workers) behind the two caches above,
+# see sharedcache.py: None, 'files' under shared_cache_dir (default cache_dir/shared,
+# use a tmpfs such as /dev/shm/lmtqldb to keep it in memory) or 'redis' at
+# shared_cache_url. With it every process keeps only the smaller shared_* limits in
+# memory, the most recently used entries, and the shared store holds the rest
+shared_cache = None
+shared_df_cache_max_bytes = 64 * 1024 * 1024
+shared_figure_cache_max_bytes = 16 * 1024 * 1024
+shared_cache_dir = None
+shared_cache_max_bytes = 2 * 1024 * 1024 * 1024
+shared_cache_url = 'redis://localhost:6379/0'
+shared_cache_ttl = 24 * 60 * 60
+
+# The ingest worker keeps the plot data of the newest hot_store_days days as memory-mapped
+# arrays under cache_dir/hot, which get_df slices instead of reading files (None disables)
+hot_store_days = 14
+
+# Scatter traces with more points than this are downsampled before they are sent
+plot_max_points = 10000
+# Traces with more points than this are drawn with WebGL (Scattergl)
+webgl_min_points = 5000
+
+# Time axis plots of more than rollup_min_days days are drawn from the hourly rollups
+# kept by the ingest worker, as the mean with a min/max band, and from the daily ones
+# beyond rollup_hourly_max_days days (None always plots every observation)
+rollup_min_days = 60
+rollup_hourly_max_days = 120
+# Fields the rollups also keep daily quantile sketches of, for the statistics panel
+# (delete cache_dir/rollups after changing them).
+# Its clipped mean drops values beyond clip_sigma standard deviations, outliers are
+# more than outlier_mads scaled MADs from the median
+summary_fields = {
+    'astigmatism': ['M1ZC0'],
+    'focus': ['M2ZOffset'],
+    'pointing': ['AzPointOffset', 'ElPointOffset'],
+}
+clip_sigma = 3
+outlier_mads = 5
+
+# Run the ingest worker as a thread of the app process. Set to False when it runs on
+# its own (python ingest.py); one process per data directory ingests at a time
+ingest_in_process = True
+# Seconds between two polls of the data folders
+ingest_interval = 10
+
+# 'csv' reads the daily files (through their sidecars), 'sqlite' queries the embedded
+# store kept by the ingest worker and falls back to the files until it is filled
+storage_backend = 'csv'
+sqlite_path = os.path.join(clean_base_dir, 'lmtqldb.sqlite')
+
+# Shared I/O pool: at most io_threads files are read at once by the whole process.
+# Loads of at least process_pool_min_files files use io_processes processes instead
+# (0 disables the process pool)
+io_threads = 8
+io_processes = 0
+process_pool_min_files = 60
+# Threads of the ingest worker's own pool for summaries, rollups and the hot store,
+# kept apart from the one above so that long ingest passes do not delay requests
+ingest_io_threads = 2
+
+# Callbacks taking at least slow_request_seconds are logged with their inputs and the
+# time of each stage (None disables the log). Lines go to slow_request_log, or are
+# printed when it is None
+slow_request_seconds = None
+slow_request_log = None
+
+
+def set_data_dirs(clean, raw):
+    # Point every data location at another tree, e.g. the synthetic one of benchmark.py.
+    # Call before the app modules are imported; folder_paths is updated in place
+    global clean_base_dir, raw_base_dir, index_dir, cache_dir, sqlite_path
+    clean_base_dir = clean
+    raw_base_dir = raw
+    index_dir = os.path.join(clean_base_dir, 'index')
+    cache_dir = os.path.join(clean_base_dir, 'cache')
+    sqlite_path = os.path.join(clean_base_dir, 'lmtqldb.sqlite')
+    folder_paths.clear()
+    folder_paths.update(data_folders(clean_base_dir, raw_base_dir))
+
+
+def settings():
+    # The current settings, for processes that import this module again and apply
+    # them with vars(config).update()
+    return {name: value for name, value in globals().items()
+            if not name.startswith('_') and not callable(value) and not isinstance(value, type(os))}
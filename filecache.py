@@ -0,0 +1,153 @@
+# Persistent columnar (Feather) sidecars for the daily CSV files.
+# A sidecar is named after the source file's mtime and size, so it is found with a
+# single stat and is rebuilt only when the CSV changes.
+import glob
+import os
+import numpy as np
+import pandas as pd
+import config
+import metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather  # noqa: F401  (needed by pd.read_feather/to_feather)
+    has_feather = True
+except ImportError:
+    has_feather = False
+
+# Bump when the sidecar contents change so that old sidecars are rebuilt
+SIDECAR_VERSION = 3
+
+
+def compact_dtypes(df):
+    # float32 values, int32 ObsNum and categorical Receiver
+    for column in df.columns:
+        if df[column].dtype == 'float64':
+            df[column] = df[column].astype('float32')
+    if 'ObsNum' in df.columns and pd.api.types.is_integer_dtype(df['ObsNum']):
+        if df.empty or df['ObsNum'].abs().max() < 2**31:
+            df['ObsNum'] = df['ObsNum'].astype('int32')
+    if 'Receiver' in df.columns:
+        df['Receiver'] = df['Receiver'].astype('category')
+    return df
+
+
+def select_columns(df, columns):
+    if columns is None:
+        return df
+    columns = set(columns)
+    return df[[column for column in df.columns if column in columns]]
+
+
+def parse_datetime(df):
+    # DateTime and TimeOfDay (seconds since midnight, UTC like the files) from the Date
+    # and Time strings. 'YYYY-MM-DD HH:MM:SS[.fff]' is parsed as ISO 8601 instead of
+    # inferring the format of every file
+    df['DateTime'] = pd.to_datetime(df['Date'] + ' ' + df['Time'], format='ISO8601')
+    nanoseconds = df['DateTime'].to_numpy(dtype='datetime64[ns]').view('int64')
+    df['TimeOfDay'] = np.where(df['DateTime'].isna(), np.nan, (nanoseconds % (86400 * 10**9)) / 1e9)
+    return df
+
+
+def read_csv_file(file_path, columns=None):
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        if 'DateTime' in wanted or 'TimeOfDay' in wanted:
+            wanted.update(['Date', 'Time'])
+        usecols = lambda column: column in wanted
+    df = compact_dtypes(pd.read_csv(file_path, usecols=usecols))
+    if not df.empty and 'Date' in df.columns and 'Time' in df.columns:
+        df = parse_datetime(df)
+    return select_columns(df, columns)
+
+
+def read_sidecar(path, columns=None):
+    if columns is None:
+        return pd.read_feather(path)
+    # Only the requested columns that the file actually has are read
+    with pa.memory_map(path) as source:
+        names = pa.ipc.open_file(source).schema.names
+    columns = set(columns)
+    return pd.read_feather(path, columns=[name for name in names if name in columns])
+
+
+def sidecar_path(folder_key, filename, stat):
+    return os.path.join(config.cache_dir, folder_key,
+                        f'{filename}.{stat.st_mtime_ns}-{stat.st_size}.v{SIDECAR_VERSION}.feather')
+
+
+def write_sidecar(path, filename, df):
+    folder = os.path.dirname(path)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(folder, exist_ok=True)
+        df.to_feather(tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Error writing cache file {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    # Drop sidecars built from older versions of the same source file
+    for old_path in glob.glob(os.path.join(glob.escape(folder), f'{glob.escape(filename)}.*.feather')):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def read_file(folder_key, folder_path, filename, columns=None):
+    # columns=None reads every column, otherwise only the listed ones present in the file
+    with metrics.span('file_read'):
+        df, size = read_file_sized(folder_key, folder_path, filename, columns)
+    metrics.add(files_read=1, rows_loaded=len(df), bytes_read=size)
+    return df
+
+
+def read_file_sized(folder_key, folder_path, filename, columns=None):
+    # Also returns the size of the file that was read, CSV or sidecar
+    file_path = os.path.join(folder_path, filename)
+    stat = os.stat(file_path)
+    if not (has_feather and config.use_sidecar_cache):
+        with metrics.span('csv_parse'):
+            return read_csv_file(file_path, columns), stat.st_size
+
+    path = sidecar_path(folder_key, filename, stat)
+    try:
+        df = read_sidecar(path, columns)
+        return df, os.path.getsize(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading cache file {path}: {e}")
+
+    with metrics.span('csv_parse'):
+        df = read_csv_file(file_path)
+    write_sidecar(path, filename, df)
+    metrics.add(sidecars_built=1)
+    return select_columns(df, columns), stat.st_size
+
+
+def apply_filters(df, receivers, obsnum_start, obsnum_end):
+    # A None ObsNum bound leaves that side open
+    if receivers and len(receivers) > 0:
+        df = df[df['Receiver'].isin(receivers)]
+    if obsnum_start is not None:
+        df = df[df['ObsNum'] >= obsnum_start]
+    if obsnum_end is not None:
+        df = df[df['ObsNum'] <= obsnum_end]
+    return df
+
+
+def read_filtered(folder_key, folder_path, filename, columns=None, receivers=None, obsnum_start=None, obsnum_end=None,
+                  file_date=None):
+    # read_file with the plot filters applied, module level so it can run in a process pool
+    df = read_file(folder_key, folder_path, filename, columns)
+    if not df.empty and (receivers or obsnum_start is not None or obsnum_end is not None):
+        with metrics.span('apply_filters'):
+            df = apply_filters(df, receivers, obsnum_start, obsnum_end)
+    if file_date is not None:
+        df = df.assign(file_date=file_date)
+    return df
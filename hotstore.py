@@ -0,0 +1,295 @@
+# Memory-mapped store of the most recent config.hot_store_days days of plot data, kept
+# by the ingest worker. Every folder is merged with the telescope lookup once and saved
+# as one .npy file per column: numbers as they are, DateTime as int64 nanoseconds,
+# Receiver and other text columns as integer codes. The app processes map the files
+# read-only, so they share the pages, and get_df slices a date range out of them
+# without reading any CSV. The Date and Time strings are not kept, plots asking for
+# them are answered from the files as before.
+# When the window changes only its new and changed files are read again, the rows of
+# the others are taken from the previous store.
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+import pandas as pd
+import config
+import filecache
+import indexer
+import iopool
+import tellookup
+
+# Bump when the stored columns change so that the stores are rebuilt
+HOT_STORE_VERSION = 3
+data_folders = ['astigmatism', 'focus', 'pointing']
+# Text columns left out, DateTime holds the same
+skipped_columns = ['Date', 'Time']
+
+lock = threading.Lock()
+# folder key -> (mtime_ns of its meta file, store) of the stores mapped by query()
+stores = {}
+
+
+def store_dir():
+    return os.path.join(config.cache_dir, 'hot')
+
+
+def meta_path(folder_key):
+    return os.path.join(store_dir(), f'{folder_key}.json')
+
+
+def read_meta(folder_key):
+    try:
+        with open(meta_path(folder_key)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading hot store of {folder_key}: {e}")
+        return None
+    return meta if meta.get('version') == HOT_STORE_VERSION else None
+
+
+def window(folder_key):
+    # Index rows of the files dated within the hot_store_days days up to the newest file
+    index_df = indexer.get_index(folder_key).index_df
+    index_df = index_df[index_df['mtime_ns'].notna()]
+    if index_df.empty:
+        return None, index_df
+    start_date = index_df['file_date'].max() - pd.Timedelta(days=config.hot_store_days - 1)
+    index_df = index_df[index_df['file_date'] >= start_date].sort_values(by=['file_date', 'filename'])
+    return start_date, index_df
+
+
+def read_parts(folder_key, index_df):
+    # The merged rows of the given files, one frame per file, each with whether all of
+    # its rows found their ObsNum in the telescope lookup
+    folder_path = config.folder_paths[folder_key]
+    n = len(index_df)
+    frames = iopool.map(filecache.read_filtered, [folder_key] * n, [folder_path] * n, index_df['filename'].tolist(),
+                        [None] * n, [None] * n, [None] * n, [None] * n, index_df['file_date'].tolist(),
+                        background=True)
+    parts = []
+    for frame in frames:
+        joined = tellookup.join(frame)
+        parts.append((joined, len(joined) == len(frame)))
+    return parts
+
+
+def stored_part(store, start, stop):
+    return pd.DataFrame({column: column_values(store, column, slice(start, stop))
+                         for column, kind in store['meta']['columns']})
+
+
+def read_window(folder_key, index_df, store=None, reused=()):
+    # The merged rows of the window files in the order get_df returns them, the rows of
+    # the reused files come from store. Also returns the rows of every file as
+    # [start, stop, whether all rows were joined]
+    read = index_df[~index_df['filename'].isin(reused)]
+    new_parts = dict(zip(read['filename'], read_parts(folder_key, read)))
+    frames = []
+    parts = {}
+    start = 0
+    for filename in index_df['filename']:
+        if filename in new_parts:
+            frame, complete = new_parts[filename]
+        else:
+            old_start, old_stop, complete = store['meta']['parts'][filename]
+            frame = stored_part(store, old_start, old_stop)
+        parts[filename] = [start, start + len(frame), complete]
+        start += len(frame)
+        if not frame.empty:
+            frames.append(frame)
+    if not frames:
+        return pd.DataFrame(), parts
+    df = pd.concat(frames, ignore_index=True)
+    if 'Receiver' in df.columns:
+        df['Receiver'] = df['Receiver'].astype('category')
+    if store is not None and reused:
+        # Columns in the order of the store, which a full read gives them in
+        order = [column for column, kind in store['meta']['columns'] if column in df.columns]
+        df = df[order + [column for column in df.columns if column not in order]]
+    return df, parts
+
+
+def write_store(folder_key, start_date, sources, parts, tel_keys, df):
+    # Columns are written to a new directory that the meta file then points to
+    name = f'{folder_key}.{time.time_ns()}'
+    path = os.path.join(store_dir(), name)
+    os.makedirs(path)
+    columns = []
+    skipped = []
+    categories = {}
+    for column in df.columns:
+        values = df[column]
+        if column in skipped_columns:
+            skipped.append(column)
+            continue
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories[column] = [str(category) for category in values.cat.categories]
+            kind = 'category'
+            array = values.cat.codes.to_numpy()
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            kind = 'datetime'
+            array = values.to_numpy(dtype='datetime64[ns]').view('int64')
+        elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            kind = 'number'
+            array = values.to_numpy()
+        elif pd.api.types.is_object_dtype(values) and values.dropna().map(type).eq(str).all():
+            # Returned as object strings again, like the files give them
+            codes = pd.Categorical(values)
+            categories[column] = codes.categories.tolist()
+            kind = 'text'
+            array = codes.codes
+        else:
+            skipped.append(column)
+            continue
+        np.save(os.path.join(path, f'{column}.npy'), np.ascontiguousarray(array))
+        columns.append([column, kind])
+    meta = {
+        'version': HOT_STORE_VERSION,
+        'dir': name,
+        'start_date': start_date.isoformat(),
+        'rows': len(df),
+        'columns': columns,
+        'skipped': skipped,
+        'categories': categories,
+        'sources': sources,
+        'parts': parts,
+        'tel_keys': tel_keys,
+    }
+    old_meta = read_meta(folder_key)
+    indexer.write_file_atomic(meta_path(folder_key), json.dumps(meta))
+    # Processes that still map the old files keep them until they map the new ones
+    if old_meta is not None and old_meta['dir'] != name:
+        shutil.rmtree(os.path.join(store_dir(), old_meta['dir']), ignore_errors=True)
+
+
+def update_folder(folder_key):
+    # Rebuild the store when a file of the window changed or the telescope lookup got
+    # ObsNums that rows of the window were missing. The lookup only grows, so its
+    # number of ObsNums tells whether it changed
+    start_date, index_df = window(folder_key)
+    if start_date is None:
+        return False
+    sources = {row.filename: [int(row.mtime_ns), int(row.size)] for row in index_df.itertuples()}
+    with tellookup.lock:
+        tellookup.load()
+        tel_keys = len(tellookup.lookup['keys'])
+    meta = read_meta(folder_key)
+    if (meta is not None and meta['sources'] == sources and meta['tel_keys'] == tel_keys and
+            meta['start_date'] == start_date.isoformat()):
+        return False
+    store = get_store(folder_key) if meta is not None else None
+    reused = []
+    if store is not None:
+        old_meta = store['meta']
+        reused = [filename for filename in sources
+                  if filename in old_meta['parts'] and old_meta['sources'].get(filename) == sources[filename] and
+                  (old_meta['parts'][filename][2] or old_meta['tel_keys'] == tel_keys)]
+    df, parts = read_window(folder_key, index_df, store, reused)
+    if reused and not set(df.columns) <= {column for column, kind in old_meta['columns']} | set(old_meta['skipped']):
+        # A changed file brought a column the store does not have
+        df, parts = read_window(folder_key, index_df)
+    if 'file_date' not in df.columns:
+        df = pd.DataFrame({'file_date': pd.Series(dtype='datetime64[ns]')})
+    write_store(folder_key, start_date, sources, parts, tel_keys, df)
+    return True
+
+
+def update():
+    # Called by the ingest worker after the indexes and the telescope lookup were updated
+    if not config.hot_store_days:
+        return False
+    changed = False
+    for folder_key in data_folders:
+        try:
+            if update_folder(folder_key):
+                changed = True
+        except Exception as e:
+            print(f"Error updating hot store of {folder_key}: {e}")
+            # A stale store must not answer queries
+            try:
+                os.remove(meta_path(folder_key))
+            except FileNotFoundError:
+                pass
+    return changed
+
+
+def get_store(folder_key):
+    # The meta and memory-mapped columns, mapped again when the ingest worker replaced them
+    path = meta_path(folder_key)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with lock:
+        cached = stores.get(folder_key)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+    meta = read_meta(folder_key)
+    if meta is None:
+        return None
+    try:
+        arrays = {column: np.load(os.path.join(store_dir(), meta['dir'], f'{column}.npy'), mmap_mode='r')
+                  for column, kind in meta['columns']}
+    except Exception as e:
+        print(f"Error mapping hot store of {folder_key}: {e}")
+        return None
+    store = {'meta': meta, 'start_date': pd.Timestamp(meta['start_date']), 'arrays': arrays,
+             'kinds': dict(meta['columns'])}
+    with lock:
+        stores[folder_key] = (mtime_ns, store)
+    return store
+
+
+def column_values(store, column, rows):
+    values = store['arrays'][column][rows].view(np.ndarray)
+    kind = store['kinds'][column]
+    if kind == 'datetime':
+        return values.view('datetime64[ns]')
+    if kind == 'category':
+        return pd.Categorical.from_codes(values, store['meta']['categories'][column]).remove_unused_categories()
+    if kind == 'text':
+        return np.asarray(pd.Categorical.from_codes(values, store['meta']['categories'][column]), dtype=object)
+    return values
+
+
+def query(name, start_date, end_date, columns, receivers=None, obsnum_start=None, obsnum_end=None):
+    # Same result as the CSV path of get_df, or None when the store does not cover the
+    # range or lacks a requested column. Without effective filters the columns of the
+    # result are read-only views of the mapped files
+    store = get_store(name)
+    if store is None or columns is None or pd.Timestamp(start_date) < store['start_date']:
+        return None
+    if any(column in store['meta']['skipped'] for column in columns):
+        return None
+    file_date = store['arrays']['file_date']
+    lo = np.searchsorted(file_date, pd.Timestamp(start_date).value, side='left')
+    hi = np.searchsorted(file_date, pd.Timestamp(end_date).value, side='right')
+    rows = slice(lo, hi)
+    keep = None
+    if receivers and 'Receiver' in store['kinds']:
+        selected = [code for code, category in enumerate(store['meta']['categories']['Receiver'])
+                    if category in receivers]
+        if len(selected) < len(store['meta']['categories']['Receiver']):
+            keep = np.isin(store['arrays']['Receiver'][rows], selected)
+    if 'ObsNum' in store['kinds'] and (obsnum_start is not None or obsnum_end is not None):
+        obsnum = store['arrays']['ObsNum'][rows]
+        in_range = np.ones(len(obsnum), dtype=bool)
+        if obsnum_start is not None:
+            in_range &= obsnum >= obsnum_start
+        if obsnum_end is not None:
+            in_range &= obsnum <= obsnum_end
+        if not in_range.all():
+            keep = in_range if keep is None else keep & in_range
+    if keep is not None:
+        rows = lo + np.flatnonzero(keep)
+    if hi <= lo or (keep is not None and len(rows) == 0):
+        return pd.DataFrame()
+
+    # Columns in the order the files and the telescope join give them
+    wanted = set(columns) | {'Telescope_AzDesPos', 'Telescope_ElDesPos'}
+    names = [column for column, kind in store['meta']['columns'] if column in wanted]
+    return pd.DataFrame({column: column_values(store, column, rows) for column in names}, copy=False)
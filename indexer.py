@@ -0,0 +1,332 @@
+# Incremental index of the daily data files in config.folder_paths.
+# Each folder index is kept in memory as a sorted date array so date range lookups
+# are a binary search. A folder is only re-listed when its mtime changes, and then
+# only the added or removed files are processed. Files of the most recent days are
+# stat'ed on every update for appended rows, older files every sweep_interval_ns for
+# files rewritten in place, and the files that changed are summarized again. The
+# index is persisted as index_dir/<folder key>.csv with the directory mtimes in
+# index_dir/manifest.json.
+# Every file also carries a summary (ObsNum range, row count and receivers) taken from
+# its sidecar, so ObsNum ranges and the receivers present can be answered without
+# opening any data file.
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import config
+import filecache
+import iopool
+import tellookup
+
+index_columns = ['filename', 'file_date', 'obsnum_min', 'obsnum_max', 'rows', 'mtime_ns', 'size', 'receivers']
+# Integer summary columns, receivers holds the receiver names joined by receiver_separator
+summary_columns = index_columns[2:7]
+receiver_separator = '|'
+manifest_filename = 'manifest.json'
+# A directory modified this recently may still be receiving files within the same
+# mtime tick, so its mtime is not trusted until the next scan
+mtime_settle_ns = 2 * 10**9
+# Files of the most recent days are re-checked on every update, all files every sweep
+recent_days = 1
+sweep_interval_ns = 10 * 60 * 10**9
+
+
+def parse_file_date(folder_key, filename):
+    parts = filename.split('_')
+    if folder_key == 'tel':
+        date_str = parts[1].split('.')[0] if len(parts) > 1 else None
+    else:
+        date_str = parts[2].split('.')[0] if len(parts) > 2 else None
+
+    if date_str is None:
+        print(f"Error processing file {filename}: Unable to extract date part")
+        return None
+
+    file_date = pd.to_datetime(date_str, format='%Y-%m-%d', errors='coerce')
+    if pd.isnull(file_date):
+        print(f"Error processing file {filename}: Invalid date format")
+        return None
+    return file_date
+
+
+def summarize_file(folder_key, folder_path, filename):
+    if folder_key == 'tel':
+        # Tel files are only read for the telescope lookup, from where the last read stopped
+        try:
+            return tellookup.read_new(folder_path, filename)
+        except Exception as e:
+            print(f"Error summarizing file {filename}: {e}")
+            return None
+    file_path = os.path.join(folder_path, filename)
+    try:
+        stat = os.stat(file_path)
+        df = filecache.read_file(folder_key, folder_path, filename)
+    except Exception as e:
+        print(f"Error summarizing file {filename}: {e}")
+        return None
+    if 'ObsNum' in df.columns and not df.empty:
+        obsnum_min, obsnum_max = df['ObsNum'].min(), df['ObsNum'].max()
+    else:
+        obsnum_min, obsnum_max = np.nan, np.nan
+    receivers = []
+    if 'Receiver' in df.columns:
+        receivers = sorted(str(receiver) for receiver in df['Receiver'].dropna().unique())
+    return {'obsnum_min': obsnum_min, 'obsnum_max': obsnum_max, 'rows': len(df),
+            'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'receivers': receiver_separator.join(receivers)}
+
+
+def read_manifest():
+    try:
+        with open(os.path.join(config.index_dir, manifest_filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error reading index manifest: {e}")
+        return {}
+
+
+def write_file_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+manifest_lock = threading.Lock()
+
+
+def update_manifest(folder_key, dir_mtime_ns):
+    with manifest_lock:
+        manifest = read_manifest()
+        if manifest.get(folder_key, {}).get('dir_mtime_ns') == dir_mtime_ns:
+            return
+        manifest[folder_key] = {'dir_mtime_ns': dir_mtime_ns}
+        write_file_atomic(os.path.join(config.index_dir, manifest_filename), json.dumps(manifest, indent=1))
+
+
+def select_files(snapshot, obsnum_start=None, obsnum_end=None):
+    # Files whose ObsNum summary shows they cannot match the ObsNum range are skipped
+    keep = np.ones(len(snapshot['filename']), dtype=bool)
+    if obsnum_start is not None:
+        keep &= ~(snapshot['obsnum_max'] < obsnum_start)
+    if obsnum_end is not None:
+        keep &= ~(snapshot['obsnum_min'] > obsnum_end)
+    return snapshot['filename'][keep].tolist(), snapshot['file_date'][keep]
+
+
+def sorted_index(index_df):
+    # index_df with the index dtypes sorted by date, and its snapshot arrays
+    index_df = index_df[index_columns].astype({column: 'Int64' for column in summary_columns} |
+                                              {'receivers': object})
+    index_df['file_date'] = pd.to_datetime(index_df['file_date'])
+    index_df = index_df.sort_values(by=['file_date', 'filename'], kind='stable').reset_index(drop=True)
+    snapshot = {
+        'filename': index_df['filename'].to_numpy(dtype=object),
+        'file_date': index_df['file_date'].to_numpy(dtype='datetime64[ns]'),
+        'obsnum_min': index_df['obsnum_min'].to_numpy(dtype='float64', na_value=np.nan),
+        'obsnum_max': index_df['obsnum_max'].to_numpy(dtype='float64', na_value=np.nan),
+        'rows': index_df['rows'].to_numpy(dtype='float64', na_value=np.nan),
+        'receivers': index_df['receivers'].to_numpy(dtype=object),
+    }
+    return index_df, snapshot
+
+
+class FolderIndex:
+    def __init__(self, folder_key, folder_path):
+        self.folder_key = folder_key
+        self.folder_path = folder_path
+        self.index_path = os.path.join(config.index_dir, f'{folder_key}.csv')
+        # Taken to load the index and to replace index_df and snapshot, never while a
+        # folder is listed or files are summarized, so lookups do not wait for update()
+        self.lock = threading.Lock()
+        # Serializes update()
+        self.update_lock = threading.Lock()
+        # Column arrays of index_df sorted by date, replaced as a whole on every change
+        self.index_df, self.snapshot = sorted_index(pd.DataFrame(columns=index_columns))
+        self.dir_mtime_ns = None
+        self.skipped = set()
+        # time.monotonic_ns() of the last update that re-checked every file
+        self.swept_ns = None
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            if os.path.exists(self.index_path):
+                # An empty receivers list is '', not a missing value
+                index_df = pd.read_csv(self.index_path, dtype={column: 'Int64' for column in summary_columns} |
+                                       {'receivers': str}, keep_default_na=False,
+                                       na_values={column: [''] for column in summary_columns})
+                index_df['file_date'] = pd.to_datetime(index_df['file_date'])
+                # Indexes written before the summary columns existed are filled in by update()
+                for column in summary_columns + ['receivers']:
+                    if column not in index_df.columns:
+                        index_df[column] = pd.NA
+                self.index_df, self.snapshot = sorted_index(index_df)
+            self.dir_mtime_ns = read_manifest().get(self.folder_key, {}).get('dir_mtime_ns')
+            self.loaded = True
+
+    def update(self):
+        self.load()
+        with self.update_lock:
+            try:
+                dir_mtime_ns = os.stat(self.folder_path).st_mtime_ns
+            except OSError as e:
+                print(f"Error indexing {self.folder_path}: {e}")
+                return False
+            index_df = self.index_df
+            removed = set()
+            index_data = []
+            if dir_mtime_ns != self.dir_mtime_ns:
+                filenames = {filename for filename in os.listdir(self.folder_path) if filename.endswith('.csv')}
+                known = set(index_df['filename'])
+                removed = known - filenames
+                for filename in sorted(filenames - known - self.skipped):
+                    file_date = parse_file_date(self.folder_key, filename)
+                    if file_date is None:
+                        self.skipped.add(filename)
+                        continue
+                    index_data.append({'filename': filename, 'file_date': file_date})
+                if removed:
+                    index_df = index_df[~index_df['filename'].isin(removed)]
+                if index_data:
+                    added_df = pd.DataFrame(index_data).reindex(columns=index_columns).astype(
+                        {column: 'Int64' for column in summary_columns} | {'receivers': object})
+                    index_df = added_df if index_df.empty else pd.concat([index_df, added_df], ignore_index=True)
+                if index_df.empty:
+                    print(f"No valid files found in {self.folder_path}")
+
+            stale = self.stale_rows(index_df)
+            if stale:
+                index_df = index_df.copy()
+                self.summarize(index_df, stale)
+
+            changed = bool(removed or index_data or stale)
+            if changed:
+                # Written before it is swapped in, a reload() meanwhile reads it back
+                index_df, snapshot = sorted_index(index_df)
+                write_file_atomic(self.index_path, index_df.to_csv(index=False))
+                with self.lock:
+                    self.index_df, self.snapshot = index_df, snapshot
+            if self.folder_key == 'tel':
+                # Plots only see the tel files through the lookup, rows appended for
+                # ObsNums it already has change nothing they show
+                changed = tellookup.update(self.folder_path, index_df)
+
+            if time.time_ns() - dir_mtime_ns > mtime_settle_ns:
+                self.dir_mtime_ns = dir_mtime_ns
+                update_manifest(self.folder_key, dir_mtime_ns)
+            return changed
+
+    def stale_rows(self, index_df):
+        # New files and files without a summary, plus files that changed on disk: today's
+        # file grows, and older files may be rewritten when they are cleaned again,
+        # which a listing does not show
+        stale = index_df.index[index_df['mtime_ns'].isna() | index_df['receivers'].isna()].tolist()
+        if index_df.empty:
+            return stale
+        checked = index_df[index_df['mtime_ns'].notna()]
+        now_ns = time.monotonic_ns()
+        if self.swept_ns is not None and now_ns - self.swept_ns < sweep_interval_ns:
+            checked = checked[checked['file_date'] >= index_df['file_date'].max() - pd.Timedelta(days=recent_days)]
+        else:
+            self.swept_ns = now_ns
+        for index, filename, mtime_ns, size in zip(checked.index, checked['filename'].tolist(),
+                                                   checked['mtime_ns'].tolist(), checked['size'].tolist()):
+            try:
+                stat = os.stat(os.path.join(self.folder_path, filename))
+            except OSError:
+                continue
+            if stat.st_mtime_ns != mtime_ns or stat.st_size != size:
+                stale.append(index)
+        return stale
+
+    def summarize(self, index_df, rows):
+        filenames = index_df.loc[rows, 'filename'].tolist()
+        summaries = iopool.map(summarize_file, [self.folder_key] * len(filenames),
+                               [self.folder_path] * len(filenames), filenames, background=True)
+        for row, summary in zip(rows, summaries):
+            if summary is not None:
+                for column, value in summary.items():
+                    index_df.loc[row, column] = value
+
+    def range_snapshot(self, start_date, end_date):
+        # Index columns sliced to the files dated within [start_date, end_date]
+        self.load()
+        snapshot = self.snapshot
+        dates = snapshot['file_date']
+        lo = np.searchsorted(dates, np.datetime64(start_date, 'ns'), side='left')
+        hi = np.searchsorted(dates, np.datetime64(end_date, 'ns'), side='right')
+        return {column: values[lo:hi] for column, values in snapshot.items()}
+
+    def dates_snapshot(self, dates):
+        # Index columns of the files dated on any of dates
+        self.load()
+        snapshot = self.snapshot
+        keep = np.isin(snapshot['file_date'], pd.to_datetime(list(dates)).normalize().to_numpy(dtype='datetime64[ns]'))
+        return {column: values[keep] for column, values in snapshot.items()}
+
+    def files_in_range(self, start_date, end_date, obsnum_start=None, obsnum_end=None):
+        snapshot = self.range_snapshot(start_date, end_date)
+        return select_files(snapshot, obsnum_start, obsnum_end)[0]
+
+    def files_on_dates(self, dates, obsnum_start=None, obsnum_end=None):
+        # (filenames, file_dates) of the files dated on any of dates, in date order
+        return select_files(self.dates_snapshot(dates), obsnum_start, obsnum_end)
+
+    def obsnum_range(self, start_date, end_date):
+        snapshot = self.range_snapshot(start_date, end_date)
+        obsnum_min = snapshot['obsnum_min'][snapshot['rows'] > 0]
+        obsnum_max = snapshot['obsnum_max'][snapshot['rows'] > 0]
+        if np.isnan(obsnum_min).all():
+            return None, None
+        return int(np.nanmin(obsnum_min)), int(np.nanmax(obsnum_max))
+
+    def reload(self):
+        # Read the persisted index again on next use, after another process updated it
+        with self.lock:
+            self.loaded = False
+
+    def dates(self):
+        self.load()
+        return self.snapshot['file_date']
+
+    def receivers(self):
+        # Names of the receivers found in any file of the folder
+        self.load()
+        receivers = set()
+        for names in set(self.snapshot['receivers']):
+            if isinstance(names, str) and names:
+                receivers.update(names.split(receiver_separator))
+        return sorted(receivers)
+
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def get_index(folder_key):
+    with indexes_lock:
+        if folder_key not in indexes:
+            indexes[folder_key] = FolderIndex(folder_key, config.folder_paths[folder_key])
+        return indexes[folder_key]
+
+
+def reload_indexes():
+    for folder_index in list(indexes.values()):
+        folder_index.reload()
+
+
+def update_indexes():
+    changed = False
+    for folder_key in config.folder_paths:
+        if get_index(folder_key).update():
+            changed = True
+    return changed
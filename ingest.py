@@ -0,0 +1,120 @@
+# Background ingest of new data files.
+# The worker polls the data folders (a stat per folder when nothing changed), updates
+# the indexes, sidecars, tel lookup, rollups and hot store as files land, and bumps the generation number
+# in index_dir/generation. Every process serving the app compares that number with the
+# one it last saw and drops its in-memory indexes and caches when it moved.
+# Run in the app process (config.ingest_in_process) or on its own with python ingest.py
+import os
+import threading
+import time
+import config
+import hotstore
+import indexer
+import rollups
+import sqlstore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+lock_filename = 'ingest.lock'
+generation_filename = 'generation'
+
+
+def generation_path():
+    return os.path.join(config.index_dir, generation_filename)
+
+
+def read_generation():
+    try:
+        with open(generation_path()) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_generation():
+    generation = read_generation() + 1
+    indexer.write_file_atomic(generation_path(), str(generation))
+    return generation
+
+
+def run_once():
+    changed = indexer.update_indexes()
+    if rollups.update():
+        changed = True
+    if config.storage_backend == 'sqlite' and sqlstore.sync():
+        changed = True
+    if hotstore.update():
+        changed = True
+    if changed:
+        bump_generation()
+    return changed
+
+
+seen = {'mtime_ns': None, 'generation': 0}
+seen_lock = threading.Lock()
+
+
+def current_generation():
+    # The generation file is only read again when its mtime changed
+    try:
+        mtime_ns = os.stat(generation_path()).st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = 0
+    with seen_lock:
+        if mtime_ns != seen['mtime_ns']:
+            seen['generation'] = read_generation()
+            seen['mtime_ns'] = mtime_ns
+        return seen['generation']
+
+
+def try_lock():
+    # Only one process per data directory ingests, the others just follow the generation
+    if fcntl is None:
+        return True
+    os.makedirs(config.index_dir, exist_ok=True)
+    lock_file = open(os.path.join(config.index_dir, lock_filename), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class IngestWorker(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name='ingest', daemon=True)
+        self.interval = interval
+        self.lock_file = None
+
+    def run(self):
+        while True:
+            if self.lock_file is None:
+                self.lock_file = try_lock()
+            if self.lock_file is not None:
+                try:
+                    run_once()
+                except Exception as e:
+                    print(f"Error ingesting data: {e}")
+            time.sleep(self.interval)
+
+
+worker = None
+worker_lock = threading.Lock()
+
+
+def start_worker():
+    # Safe to call on every request, a worker is started once per process
+    global worker
+    with worker_lock:
+        if worker is None or not worker.is_alive():
+            worker = IngestWorker(config.ingest_interval)
+            worker.start()
+    return worker
+
+
+if __name__ == '__main__':
+    IngestWorker(config.ingest_interval).run()
@@ -0,0 +1,123 @@
+# Process wide pools for file reads, shared by every loader.
+# The thread pool has config.io_threads workers, which is the global limit on the
+# number of files read at once however many callbacks load data concurrently.
+# Loads of at least config.process_pool_min_files files go to a pool of
+# config.io_processes processes instead, since CSV parsing partly holds the GIL.
+# The processes get the settings of config at the time the pool was started, and
+# are started again when they changed, e.g. by config.set_data_dirs().
+# The ingest worker's reads (background=True) go to a separate pool of
+# config.ingest_io_threads threads, so a first ingest or a sidecar rebuild queueing
+# thousands of files does not hold up the loads of requests.
+import atexit
+import concurrent.futures
+import multiprocessing
+import threading
+import config
+import metrics
+
+lock = threading.Lock()
+# 'threads', 'processes' or 'background' -> executor
+pools = {}
+# config.settings() the process pool was started with
+process_settings = {}
+counters = {'submitted': 0, 'completed': 0, 'running': 0, 'max_queued': 0, 'process_submitted': 0,
+            'background_submitted': 0, 'background_completed': 0, 'background_running': 0}
+
+
+def init_process(settings):
+    vars(config).update(settings)
+
+
+def get_pool(kind='threads'):
+    with lock:
+        if kind == 'processes' and kind in pools and process_settings != config.settings():
+            pools.pop(kind).shutdown(wait=False)
+        if kind not in pools:
+            if kind == 'processes':
+                # spawn, since forking a process that runs threads is not safe
+                process_settings.clear()
+                process_settings.update(config.settings())
+                pools[kind] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=config.io_processes, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=init_process, initargs=(dict(process_settings),))
+            elif kind == 'background':
+                pools[kind] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=config.ingest_io_threads, thread_name_prefix='ingest-io')
+            else:
+                pools[kind] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=config.io_threads, thread_name_prefix='io')
+        return pools[kind]
+
+
+def count(**changes):
+    with lock:
+        for name, change in changes.items():
+            counters[name] += change
+        queued = counters['submitted'] - counters['completed'] - counters['running']
+        counters['max_queued'] = max(counters['max_queued'], queued)
+
+
+def run(fn, args, request, prefix=''):
+    # request is the metrics breakdown of the callback that submitted fn, prefix that
+    # of the counters of the pool
+    count(**{f'{prefix}running': 1})
+    metrics.local.request = request
+    try:
+        return fn(*args)
+    finally:
+        metrics.local.request = None
+        count(**{f'{prefix}running': -1, f'{prefix}completed': 1})
+
+
+def use_processes(n_items):
+    return config.io_processes > 0 and 0 < config.process_pool_min_files <= n_items
+
+
+def map(fn, *iterables, background=False):
+    # Like Executor.map, but results are returned as a list. With the process pool
+    # fn and its arguments must be picklable, i.e. fn a module level function.
+    # Background jobs of the ingest worker always run on threads of this process, so
+    # they may change its module state, e.g. the tel files read into tellookup
+    items = list(zip(*iterables))
+    if not items:
+        return []
+    if background:
+        count(background_submitted=len(items))
+        pool = get_pool('background')
+        futures = [pool.submit(run, fn, args, None, 'background_') for args in items]
+        return [future.result() for future in futures]
+    processes = use_processes(len(items))
+    pool = get_pool('processes' if processes else 'threads')
+    if processes:
+        count(submitted=len(items), process_submitted=len(items))
+        futures = [pool.submit(fn, *args) for args in items]
+        for future in futures:
+            future.add_done_callback(lambda future: count(completed=1))
+    else:
+        count(submitted=len(items))
+        request = getattr(metrics.local, 'request', None)
+        futures = [pool.submit(run, fn, args, request) for args in items]
+    return [future.result() for future in futures]
+
+
+def stats():
+    with lock:
+        stats = dict(counters)
+    stats['queued'] = stats['submitted'] - stats['completed'] - stats['running']
+    stats['background_queued'] = (stats['background_submitted'] - stats['background_completed'] -
+                                  stats['background_running'])
+    stats['threads'] = config.io_threads
+    stats['background_threads'] = config.ingest_io_threads
+    stats['processes'] = config.io_processes
+    return stats
+
+
+metrics.register_collector('io_pool', stats)
+
+
+@atexit.register
+def shutdown():
+    with lock:
+        for pool in pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        pools.clear()
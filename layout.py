@@ -2,12 +2,11 @@
 import pandas as pd
 from dash import html, dcc
 import dash_bootstrap_components as dbc
-from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import datetime
-from datetime import timedelta, datetime
-import os
-import concurrent.futures
+from datetime import timedelta, datetime, timezone
+import functools
+import json
 
 # Define styles
 title_style = {'textAlign': 'center', 'margin': '10px','backgroundColor': '#17a2b8',}
@@ -22,18 +21,22 @@ lighter_outline_style = {
     'borderColor': '#c0c0c0',  # Light gray color for the outline
 }
 #Define constants
-clean_base_dir = '/home/lmtmc/lmtqldb/cleaned_data'
-raw_base_dir = '/raw/lmtqldb'
-#
-# clean_base_dir = '/home/lmt/raw_data/lmtqldb/cleaned_data'
-# raw_base_dir = '/home/lmt/raw_data/lmtqldb/raw_data'
-index_dir = os.path.join(clean_base_dir, 'index')
-folder_paths = {
-        'astigmatism': f'{clean_base_dir}/astigmatism_cleaned',
-        'focus': f'{clean_base_dir}/focus_cleaned',
-        'pointing': f'{clean_base_dir}/pointing_cleaned',
-        'tel': f'{raw_base_dir}/tel',
-    }
+from config import folder_paths
+import config
+import filecache
+from filecache import apply_filters
+import iopool
+import metrics
+import indexer
+import ingest
+import tellookup
+import hotstore
+import sqlstore
+import plotting
+import rollups
+import sharedcache
+import summaries
+from cache import DataFrameCache, FigureCache
 
 astig_fields = ['M1ZC0']
 focus_fields = ['M2XOffset', 'M2YOffset', 'M2ZOffset']
@@ -59,122 +62,198 @@ default_receivers = [
     'Muscat',
     'Toltec']
 
+def utc_now():
+    # The data files are dated and timed in UTC, so is 'today' of the date selectors
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-def create_index_file(folder_path, index_filename):
-    index_data = []
+# get_df results shared by all callbacks, see get_df_cache_stats()
+shared_cache = sharedcache.create_store()
+df_cache = DataFrameCache(config.df_cache_max_bytes if shared_cache is None else config.shared_df_cache_max_bytes,
+                          shared_cache)
+metrics.register_collector('df_cache', df_cache.stats)
+# Figures of the plot callbacks, see get_plot() and get_compare_plot()
+figure_cache = FigureCache(
+    config.figure_cache_max_bytes if shared_cache is None else config.shared_figure_cache_max_bytes, shared_cache)
+metrics.register_collector('figure_cache', figure_cache.stats)
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.csv'):
-            try:
-                parts = filename.split('_')
 
-                if 'tel' in folder_path:
-                    date_str = parts[1].split('.')[0] if len(parts) > 1 else None
-                else:
-                    date_str = parts[2].split('.')[0] if len(parts) > 2 else None
+# Ingest generation the in-memory indexes and cached data belong to
+data_generation = {'value': None}
 
-                if date_str is None:
-                    print(f"Error processing file {filename}: Unable to extract date part")
-                    continue
 
-                file_date = pd.to_datetime(date_str, format='%Y-%m-%d', errors='coerce')
-                if pd.isnull(file_date):
-                    print(f"Error processing file {filename}: Invalid date format")
-                    continue
+def refresh_data():
+    # Cheap check on every data access: a stat of the ingest generation file.
+    # New or removed data files make the indexes and cached get_df results stale
+    generation = ingest.current_generation()
+    if generation != data_generation['value']:
+        if data_generation['value'] is not None:
+            indexer.reload_indexes()
+        df_cache.set_generation(generation)
+        figure_cache.set_generation(generation)
+        data_generation['value'] = generation
 
-                index_data.append([filename, file_date])
-            except Exception as e:
-                print(f"Error processing file {filename}: {e}")
-                continue
 
-    if index_data:
-        index_df = pd.DataFrame(index_data, columns=['filename', 'file_date'])
-        index_df = index_df.sort_values(by='file_date').reset_index(drop=True)
-        # Ensure the directory exists
-        os.makedirs(index_dir, exist_ok=True)
-        index_df.to_csv(os.path.join(index_dir, index_filename), index=False)
-    else:
-        print(f"No valid files found in {folder_path}")
 def create_index_files():
-    for folder_key, folder_path in folder_paths.items():
-        create_index_file(folder_path, f'{folder_key}.csv')
-
-create_index_files()
-def load_data(folder_path, start_date, end_date):
-    start_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
+    # Index in the calling process, normally left to the ingest worker
+    changed = ingest.run_once()
+    refresh_data()
+    return changed
 
+def get_folder_key(folder_path):
     if 'astigmatism' in folder_path:
-        index_filename = 'astigmatism.csv'
+        return 'astigmatism'
     elif 'focus' in folder_path:
-        index_filename = 'focus.csv'
+        return 'focus'
     elif 'pointing' in folder_path:
-        index_filename = 'pointing.csv'
+        return 'pointing'
     elif 'tel' in folder_path:
-        index_filename = 'tel.csv'
+        return 'tel'
     else:
         raise ValueError(f"Invalid folder_path: {folder_path}")
 
-    index_df = pd.read_csv(os.path.join(index_dir, index_filename))
-    index_df['file_date'] = pd.to_datetime(index_df['file_date'])
-
-    valid_files = index_df[(index_df['file_date'] >= start_date) & (index_df['file_date'] <= end_date)][
-        'filename'].tolist()
-    def read_and_process_file(filename):
-        file_path = os.path.join(folder_path, filename)
-        df = pd.read_csv(file_path)
-        if not df.empty:
-            df['DateTime'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
-        return df
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        dataframes = list(executor.map(read_and_process_file, valid_files))
+def load_files(folder_path, filenames, columns=None, receivers=None, obsnum_start=None, obsnum_end=None,
+               file_dates=None):
+    # Read filenames in one pass of the shared I/O pool. Receiver and ObsNum filters are
+    # applied to each file as it is read. With file_dates rows are tagged with their date
+    folder_key = get_folder_key(folder_path)
+    if file_dates is None:
+        file_dates = [None] * len(filenames)
+    n = len(filenames)
+    with metrics.span('load_files'):
+        dataframes = iopool.map(filecache.read_filtered, [folder_key] * n, [folder_path] * n, filenames, [columns] * n,
+                                [receivers] * n, [obsnum_start] * n, [obsnum_end] * n, file_dates)
 
     dataframes = [df for df in dataframes if not df.empty]
 
     if not dataframes:
         return pd.DataFrame()
 
-    return pd.concat(dataframes, ignore_index=True)
+    df = pd.concat(dataframes, ignore_index=True)
+    # Receiver categories differ between files, so concat falls back to object
+    if 'Receiver' in df.columns:
+        df['Receiver'] = df['Receiver'].astype('category')
+    return df
+
+def load_data(folder_path, start_date, end_date, columns=None, receivers=None, obsnum_start=None, obsnum_end=None):
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+
+    folder_index = indexer.get_index(get_folder_key(folder_path))
+    with metrics.span('index_lookup'):
+        valid_files = folder_index.files_in_range(start_date, end_date, obsnum_start, obsnum_end)
+    return load_files(folder_path, valid_files, columns, receivers, obsnum_start, obsnum_end)
+
+def load_dates(folder_path, dates, columns=None, receivers=None, obsnum_start=None, obsnum_end=None):
+    # Files of an arbitrary set of days, rows tagged with their file_date
+    folder_index = indexer.get_index(get_folder_key(folder_path))
+    with metrics.span('index_lookup'):
+        valid_files, file_dates = folder_index.files_on_dates(dates, obsnum_start, obsnum_end)
+    return load_files(folder_path, valid_files, columns, receivers, obsnum_start, obsnum_end, file_dates)
+
+# Dates and receivers present per folder, built from the in-memory indexes once per
+# ingest generation for the layout and its options
+catalog = {'generation': None, 'folders': None}
+
+
+def get_catalog():
+    refresh_data()
+    generation = data_generation['value']
+    if catalog['folders'] is None or catalog['generation'] != generation:
+        folders = {}
+        for name in ['astigmatism', 'focus', 'pointing']:
+            folder_index = indexer.get_index(name)
+            dates = pd.DatetimeIndex(folder_index.dates()).strftime('%Y-%m-%d').tolist()
+            dates.reverse()
+            folders[name] = {'dates': dates, 'receivers': folder_index.receivers()}
+        catalog.update(generation=generation, folders=folders)
+    return catalog['folders']
 
 def get_dates(name):
     if name == 'astig':
        name = 'astigmatism'
-    index_filename = f'{name}.csv'
-    index_df = pd.read_csv(os.path.join(index_dir, index_filename))
-    dates = index_df['file_date'].tolist()
-    dates.reverse()
-    return dates
-
-def get_df(name, start_date, end_date):
+    return get_catalog()[name]['dates']
 
+def get_df(name, start_date, end_date, columns=None, receivers=None, obsnum_start=None, obsnum_end=None):
+    # The optional receiver and ObsNum filters are applied while loading
+    refresh_data()
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
     if name == 'astig':
        name = 'astigmatism'
 
-    df_main = load_data(folder_paths[name], start_date, end_date)
+    # Files are indexed by day, so the range only matters to the day
+    start_date = start_date.ceil('D')
+    end_date = end_date.floor('D')
+    # ObsNum is always needed for the telescope join, Receiver for its filter
+    if columns is not None:
+        columns = tuple(sorted(set(columns) | {'ObsNum'} | ({'Receiver'} if receivers else set())))
+    receivers = tuple(sorted(receivers)) if receivers else ()
+    # The returned DataFrame is shared between callers and must not be modified in place
+    key = (name, start_date, end_date, columns, receivers, obsnum_start, obsnum_end)
+    with metrics.span('get_df'):
+        return df_cache.get_or_build(key, lambda: build_df(
+            name, start_date, end_date, columns, receivers, obsnum_start, obsnum_end))
+
+def get_df_cache_stats():
+    return df_cache.stats()
+
+def build_df(name, start_date, end_date, columns=None, receivers=None, obsnum_start=None, obsnum_end=None):
+    # Recent days are sliced from the hot store, the SQLite store filters and joins in
+    # SQL, the CSV path is the fallback
+    if config.hot_store_days:
+        with metrics.span('hot_store'):
+            df = hotstore.query(name, start_date, end_date, columns, receivers, obsnum_start, obsnum_end)
+        if df is not None:
+            return df
+    if config.storage_backend == 'sqlite':
+        with metrics.span('sql_query'):
+            df = sqlstore.query(name, start_date, end_date, columns, receivers, obsnum_start, obsnum_end)
+        if df is not None:
+            return df
+
+    # Filters are pushed into the load, so only matching rows reach the join
+    df_main = load_data(folder_paths[name], start_date, end_date, columns, receivers, obsnum_start, obsnum_end)
     if df_main.empty:
         return pd.DataFrame()
 
-    df_tel = load_data(folder_paths['tel'], start_date, end_date)
-
-    if df_tel.empty:
+    # Telescope positions come from the persisted ObsNum lookup, not from the tel CSVs
+    with metrics.span('tel_join'):
+        df = tellookup.join(df_main)
+    if df.empty:
         return pd.DataFrame()
 
-    df_tel = df_tel.drop_duplicates(subset='ObsNum', keep='first')
-    required_columns = ['ObsNum', 'Telescope_AzDesPos', 'Telescope_ElDesPos']
-    if not all(col in df_tel.columns for col in required_columns):
-        print(f"Required columns not found in df_tel: {required_columns}")
-        return pd.DataFrame()
+    return df
 
-    df_tel = df_tel[required_columns]
-    df = pd.merge(df_main, df_tel, on='ObsNum', how='inner')
+
+def get_df_dates(name, dates, columns=None, receivers=None, obsnum_start=None, obsnum_end=None):
+    # Like get_df for a set of possibly non-contiguous days, loaded and joined at once.
+    # Rows carry the file_date of the day they belong to
+    refresh_data()
+    if name == 'astig':
+       name = 'astigmatism'
+    dates = tuple(sorted(set(pd.to_datetime(list(dates)).normalize())))
+    if columns is not None:
+        columns = tuple(sorted(set(columns) | {'ObsNum'} | ({'Receiver'} if receivers else set())))
+    receivers = tuple(sorted(receivers)) if receivers else ()
+    key = ('dates', name, dates, columns, receivers, obsnum_start, obsnum_end)
+    with metrics.span('get_df'):
+        return df_cache.get_or_build(key, lambda: build_df_dates(
+            name, dates, columns, receivers, obsnum_start, obsnum_end))
+
+def build_df_dates(name, dates, columns=None, receivers=None, obsnum_start=None, obsnum_end=None):
+    if config.storage_backend == 'sqlite':
+        with metrics.span('sql_query'):
+            df = sqlstore.query(name, None, None, columns, receivers, obsnum_start, obsnum_end, dates)
+        if df is not None:
+            return df
+
+    df_main = load_dates(folder_paths[name], dates, columns, receivers, obsnum_start, obsnum_end)
+    if df_main.empty:
+        return pd.DataFrame()
+    with metrics.span('tel_join'):
+        df = tellookup.join(df_main)
     if df.empty:
         return pd.DataFrame()
-    df['Telescope_AzDesPos'] = df['Telescope_AzDesPos']*180/3.14159
-    df['Telescope_ElDesPos'] = df['Telescope_ElDesPos']*180/3.14159
-
     return df
 
 
@@ -220,7 +299,7 @@ def adjust_date_range(triggered_id,start_date,end_date):
 
     elif triggered_id == 'this-week':
         # set start_date to today
-        end_date = pd.to_datetime(datetime.now().date())
+        end_date = pd.to_datetime(utc_now().date())
         start_date = end_date - pd.DateOffset(weeks=1)
     return start_date, end_date
 
@@ -350,12 +429,12 @@ def create_obsnum_selector(name):
                             dbc.Row([
                                 dbc.Col(dbc.Label('ObsNum'), width='auto'),
                                 dbc.Col(dcc.Input(id=f'{name}-obsnum-start', type='number',style=NUMBER_INPUT_STYLE,
-                                                  value=get_obsnum_range(name,datetime.now() - timedelta(days=7), datetime.now())[0]
+                                                  value=get_obsnum_range(name,utc_now() - timedelta(days=7), utc_now())[0]
                                                   ),
                                         width='auto'),
                                 dbc.Col(dbc.Label('to'), width='auto', style={'textAlign': 'center'}),
                                 dbc.Col(dcc.Input(id=f'{name}-obsnum-end', type='number',style=NUMBER_INPUT_STYLE,
-                                        value=get_obsnum_range(name,datetime.now() - timedelta(days=7), datetime.now())[1]
+                                        value=get_obsnum_range(name,utc_now() - timedelta(days=7), utc_now())[1]
                                                   ),width='auto'),
                             ],align='center'),
                         ], className='mb-1'
@@ -382,6 +461,8 @@ def create_filter(name):
                         dbc.Col(dcc.Dropdown(id=f'{name}-compare-y-axis', multi=True, options=get_fields(name), value=value))],className='mb-1'),
                     ]),
 def create_compare_modal(name):
+    # The index may still be empty until the ingest worker ran for the first time
+    dates = get_dates(name)
     return dbc.Modal(
     [
         dbc.ModalHeader(html.H5(f"Compare {name.capitalize()} Plot")),
@@ -390,8 +471,8 @@ def create_compare_modal(name):
                 dbc.Row(dbc.Col([
                     dbc.Label('Select Dates'), dcc.Dropdown(
                     id=f'{name}-multi-date-picker',
-                    options=[{'label': date, 'value': date} for date in get_dates(name)],
-                        value=get_dates(name)[0],
+                    options=[{'label': date, 'value': date} for date in dates],
+                        value=dates[0] if dates else None,
                     multi=True
                     )]),className='mb-3'),
                 dbc.Row(create_filter(name)),
@@ -411,113 +492,221 @@ def create_compare_modal(name):
 
 
 def get_receivers(name):
+    # Receivers present in the data of name, or of any plot for 'same'. The fixed
+    # lists are used until the index knows them
     if name == 'astig':
         receivers = [default_receivers[i] for i in [1,5,6,9,10]
                         ]
     elif name == 'focus':
         receivers = [default_receivers[i] for i in [1,2,3,5,6,7,9,10]]
-    elif name == 'pointing':
+    elif name == 'pointing' or name == 'same':
         receivers = default_receivers
-    return receivers
+    folders = get_catalog()
+    if name == 'same':
+        present = sorted(set().union(*(folder['receivers'] for folder in folders.values())))
+    else:
+        present = folders['astigmatism' if name == 'astig' else name]['receivers']
+    return present if present else receivers
 
 def get_obsnum_range(name, start_date, end_date):
-    df_astig = get_df('astig', start_date, end_date)
-    df_focus = get_df('focus', start_date, end_date)
-    df_pointing = get_df('pointing', start_date, end_date)
-    df_dict = {
-        'astig': df_astig,
-        'focus': df_focus,
-        'pointing': df_pointing,
+    # Answered from the per-file ObsNum summaries in the index, no data file is read
+    refresh_data()
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+    range_dict = {
+        'astig': indexer.get_index('astigmatism').obsnum_range(start_date, end_date),
+        'focus': indexer.get_index('focus').obsnum_range(start_date, end_date),
+        'pointing': indexer.get_index('pointing').obsnum_range(start_date, end_date),
     }
 
-    obsnum_start_list = []
-    obsnum_end_list = []
-
-    # Check if DataFrame is not empty before accessing 'ObsNum'
-    for key, df in df_dict.items():
-        if not df.empty:
-            obsnum_start_list.append(df['ObsNum'].min())
-            obsnum_end_list.append(df['ObsNum'].max())
+    obsnum_start_list = [start for start, end in range_dict.values() if start is not None]
+    obsnum_end_list = [end for start, end in range_dict.values() if end is not None]
 
     # If no valid 'ObsNum' values are found, return None or appropriate default values
     if not obsnum_start_list or not obsnum_end_list:
         return None, None
 
-    obsnum_start = min(obsnum_start_list)
-    obsnum_end = max(obsnum_end_list)
-    if name in df_dict:
-        return df_dict[name]['ObsNum'].min(), df_dict[name]['ObsNum'].max()
+    if name in range_dict:
+        return range_dict[name]
     elif name == 'same':
-        return obsnum_start, obsnum_end
-
-def apply_filters(df, receivers, obsnum_start, obsnum_end):
-    if receivers and len(receivers) > 0:
-        df = df[df['Receiver'].isin(receivers)]
-    mask_obsnum = (df['ObsNum'] >= obsnum_start) & (df['ObsNum'] <= obsnum_end)
-    df = df[mask_obsnum]
+        return min(obsnum_start_list), max(obsnum_end_list)
+
+def get_plot_columns(name):
+    # Every column the plot of name can show, Time is drawn from DateTime
+    columns = ['ObsNum', 'Receiver', 'DateTime'] + get_fields(name) + get_x_axis(name)
+    return [column for column in columns if column != 'Time']
+
+def get_filtered_df(name, date_start, date_end, obsnum_start, obsnum_end, receivers):
+    # Filtered plot data, built once per settings and shared by every figure callback
+    return get_df(name, date_start, date_end, get_plot_columns(name), receivers, obsnum_start, obsnum_end)
+
+def fetch_data(date_start, date_end, obsnum_start, obsnum_end, receivers):
+    # Load and filter the data of all plots for one settings change, the returned
+    # settings are the key the figure callbacks use to find it again
+    settings = {
+        'date_start': pd.to_datetime(date_start).ceil('D').isoformat(),
+        'date_end': pd.to_datetime(date_end).floor('D').isoformat(),
+        'obsnum_start': obsnum_start,
+        'obsnum_end': obsnum_end,
+        'receivers': sorted(receivers) if receivers else [],
+    }
+    for name in ['astig', 'focus', 'pointing']:
+        get_filtered_df(name, **settings)
+    return settings
+
+def get_rollup_freq(name, date_start, date_end, obsnum_start, obsnum_end, x_axis, x_range=None):
+    # 'hourly' or 'daily' when the plot is drawn from the rollups, None for every observation
+    if x_axis != 'Time' or config.rollup_min_days is None:
+        return None
+    date_start = pd.to_datetime(date_start).ceil('D')
+    date_end = pd.to_datetime(date_end).floor('D')
+    window_start, window_end = date_start, date_end + pd.Timedelta(days=1)
+    if x_range is not None:
+        window_start, window_end = pd.to_datetime(x_range[0]), pd.to_datetime(x_range[1])
+    days = (window_end - window_start) / pd.Timedelta(days=1)
+    if days <= config.rollup_min_days:
+        return None
+    if obsnum_filter_cuts(name, date_start, date_end, obsnum_start, obsnum_end):
+        return None
+    return 'hourly' if days <= config.rollup_hourly_max_days else 'daily'
+
+def obsnum_filter_cuts(name, date_start, date_end, obsnum_start, obsnum_end):
+    # Rollups have no ObsNum, so they only serve ObsNum filters that keep the whole range
+    obsnum_min, obsnum_max = indexer.get_index('astigmatism' if name == 'astig' else name).obsnum_range(
+        date_start, date_end)
+    return obsnum_min is not None and ((obsnum_start is not None and obsnum_start > obsnum_min) or
+                                       (obsnum_end is not None and obsnum_end < obsnum_max))
+
+def get_rollup_df(name, date_start, date_end, receivers, selected_fields, freq, x_range=None):
+    date_start = pd.to_datetime(date_start).ceil('D')
+    date_end = pd.to_datetime(date_end).floor('D')
+    with metrics.span('rollup_query'):
+        df = rollups.query('astigmatism' if name == 'astig' else name, freq, date_start, date_end,
+                           selected_fields, receivers)
+    if df is not None and x_range is not None:
+        df = plotting.filter_x_range(df, 'bucket', x_range)
     return df
 
-def make_plot(name, date_start, date_end, obsnum_start, obsnum_end, receivers, x_axis, selected_fields):
+@metrics.timed('make_plot')
+def make_plot(name, date_start, date_end, obsnum_start, obsnum_end, receivers, x_axis, selected_fields, x_range=None):
+    # x_range is the visible x window of a zoomed plot, re-queried at full resolution.
+    # Long Time axis windows are drawn from the rollups instead, see get_rollup_freq()
     if selected_fields is None:
         selected_fields = []
     if not isinstance(selected_fields, list):
         selected_fields = [selected_fields]
-    # Get the dataframe
-    df = get_df(name,date_start,date_end)
+    freq = None
+    if selected_fields:
+        freq = get_rollup_freq(name, date_start, date_end, obsnum_start, obsnum_end, x_axis, x_range)
+    df = None
+    if freq is not None:
+        df = get_rollup_df(name, date_start, date_end, receivers, selected_fields, freq, x_range)
+    if df is not None:
+        x_axis = 'bucket'
+        traces = lambda y: plotting.make_band(df['bucket'], df[f'{y}.mean'], df[f'{y}.min'], df[f'{y}.max'],
+                                              f'{y} {freq}')
+        x_title = f'DateTime ({freq} mean, min and max)'
+    else:
+        # Get the filtered dataframe
+        df = get_filtered_df(name, date_start, date_end, obsnum_start, obsnum_end, receivers)
+        x_axis = 'DateTime' if x_axis == 'Time' else x_axis
+        traces = lambda y: [plotting.make_scatter(df[x_axis], df[y], mode='markers')]
+        x_title = f'{x_axis}'
     if not selected_fields or not x_axis or x_axis not in df.columns or df.empty:
-        fig = go.Figure()
-        fig.add_annotation(text='No data selected', showarrow=False, xref='paper', yref='paper', x=0.5, y=0.5)
-        return fig
+        return plotting.message_figure('No data selected')
 
-    # Apply filters
-    df = apply_filters(df, receivers, obsnum_start, obsnum_end)
+    if x_range is not None and freq is None:
+        df = plotting.filter_x_range(df, x_axis, x_range)
     if df.empty:
-        fig = go.Figure()
-        fig.add_annotation(text='No data selected', showarrow=False, xref='paper', yref='paper', x=0.5, y=0.5)
-        return fig
-    # Set row heights and create subplots
-    num_rows = len(selected_fields)
-    min_row_height = 200
-    total_height = num_rows * min_row_height
-    x_axis = 'DateTime' if x_axis == 'Time' else x_axis
-    # Create subplots with shared x-axes
-    if num_rows == 1:
-        # Single subplot case
-        fig = make_subplots(rows=1, cols=1)
-        fig.add_trace(
-            go.Scatter(x=df[x_axis], y=df[selected_fields[0]], mode='markers')
-        )
-        fig.update_yaxes(title_text=f'{selected_fields[0]}')
-        fig.update_xaxes(title_text=f'{x_axis}')
-    else:
-        # Multiple subplot case
-        fig = make_subplots(
-            rows=num_rows, cols=1, row_heights=[1] * num_rows, vertical_spacing=0.05,shared_xaxes=True,
-        )
-
-        for idx, y in enumerate(selected_fields, start=1):
-            fig.add_trace(go.Scatter(x=df[x_axis], y=df[y], mode='markers'), row=idx, col=1)
-            fig.update_yaxes(title_text=f'{y}', row=idx, col=1)
-        fig.update_xaxes(title_text=f'{x_axis}', row=num_rows, col=1)
-        fig.update_layout(height=total_height, showlegend=False, margin=dict(l=50, r=50, t=50, b=50))
+        return plotting.message_figure('No data selected')
+    # The figure is built as a dict on a cached make_subplots skeleton, one row per field
+    # with shared x-axes
+    fig, axes = plotting.subplots_figure(len(selected_fields))
+    x_type = 'date' if plotting.is_datetime(df[x_axis]) else None
+    for (xaxis, yaxis), y in zip(axes, selected_fields):
+        for trace in traces(y):
+            trace.update(xaxis=xaxis.replace('axis', ''), yaxis=yaxis.replace('axis', ''))
+            fig['data'].append(trace)
+        fig['layout'][yaxis]['title'] = {'text': f'{y}'}
+        if x_type is not None:
+            fig['layout'][xaxis]['type'] = x_type
+        if x_range is not None:
+            fig['layout'][xaxis]['range'] = list(x_range)
+    fig['layout'][axes[-1][0]]['title'] = {'text': x_title}
     return fig
+
+def get_summary(name, date_start, date_end, obsnum_start, obsnum_end, receivers, selected_fields):
+    # Per receiver statistics of the selected fields, merged from the daily sketches of
+    # the rollups where they exist, computed from the loaded plot data otherwise
+    folder_key = 'astigmatism' if name == 'astig' else name
+    fields = as_tuple(selected_fields)
+    date_start = pd.to_datetime(date_start).ceil('D')
+    date_end = pd.to_datetime(date_end).floor('D')
+    summaries_list = []
+    sketched = [field for field in fields if field in config.summary_fields.get(folder_key, [])]
+    if sketched and not obsnum_filter_cuts(name, date_start, date_end, obsnum_start, obsnum_end):
+        with metrics.span('summary_sketches'):
+            summary = summaries.from_sketches(folder_key, date_start, date_end, sketched, receivers)
+        if summary is not None:
+            summaries_list.append(summary)
+            fields = [field for field in fields if field not in sketched]
+    if fields:
+        df = get_filtered_df(name, date_start, date_end, obsnum_start, obsnum_end, receivers)
+        with metrics.span('summary_scan'):
+            summaries_list.append(summaries.from_df(df, fields))
+    summary = pd.concat(summaries_list, ignore_index=True) if summaries_list else pd.DataFrame(
+        columns=summaries.columns)
+    return summary.sort_values(by=['field', 'Receiver'], ignore_index=True)
+
+def create_summary_table(summary):
+    if summary.empty:
+        return html.Small('No statistics for the selected data', className='text-muted')
+    table = pd.DataFrame({
+        'Field': summary['field'],
+        'Receiver': summary['Receiver'],
+        'N': summary['count'],
+        'Mean': summary['mean'].map('{:.4g}'.format),
+        'Median': summary['median'].map('{:.4g}'.format),
+        'MAD': summary['mad'].map('{:.3g}'.format),
+        f'{config.clip_sigma}σ mean': summary['clipped_mean'].map('{:.4g}'.format),
+        'Outliers': summary['outliers'],
+        'Drift/day': summary['drift_per_day'].map('{:.3g}'.format),
+    })
+    return dbc.Table.from_dataframe(table, size='sm', striped=True, className='mb-0')
+
+def get_summary_table(name, date_start, date_end, obsnum_start, obsnum_end, receivers, selected_fields):
+    return create_summary_table(get_summary(name, date_start, date_end, normalize_obsnum(obsnum_start),
+                                            normalize_obsnum(obsnum_end), receivers, selected_fields))
+
+def normalize_obsnum(obsnum):
+    # The number inputs send 123 or 123.0 for the same ObsNum
+    if obsnum is not None and float(obsnum).is_integer():
+        return int(obsnum)
+    return obsnum
+
+def as_tuple(values):
+    if values is None:
+        return ()
+    if isinstance(values, (list, tuple)):
+        return tuple(values)
+    return (values,)
+
+def get_plot(name, date_start, date_end, obsnum_start, obsnum_end, receivers, x_axis, selected_fields, x_range=None):
+    # make_plot through the figure cache, the figure is returned as a plain dict
+    refresh_data()
+    key = ('plot', 'astigmatism' if name == 'astig' else name,
+           pd.to_datetime(date_start).ceil('D'), pd.to_datetime(date_end).floor('D'),
+           normalize_obsnum(obsnum_start), normalize_obsnum(obsnum_end), tuple(sorted(receivers or ())),
+           x_axis, as_tuple(selected_fields), as_tuple(x_range))
+    return figure_cache.get_figure(key, lambda: make_plot(
+        name, date_start, date_end, obsnum_start, obsnum_end, receivers, x_axis, selected_fields, x_range))
+
 # dash layout components
 
-def make_compare_plot(modal_type, dates, obsnum_start, obsnum_end, receivers, y_axis):
+@functools.lru_cache(maxsize=2)
+def compare_skeleton(today):
+    # JSON of the empty compare figure, its x range is the first half of today (UTC)
     fig = go.Figure()
-    for date in dates:
-        df = get_df(modal_type, date, date)
-        if df.empty:
-            continue
-        df = apply_filters(df, receivers, obsnum_start, obsnum_end)
-        if df.empty:
-            continue
-        for y in y_axis:
-            fig.add_trace(go.Scatter(
-                x=pd.to_datetime(df['Time']),
-                y=df[y],
-                mode='lines+markers',
-                name=f'{date} {y}'))
     fig.update_layout(showlegend=True,
                       xaxis=dict(
                           tickmode='array',
@@ -526,12 +715,44 @@ def make_compare_plot(modal_type, dates, obsnum_start, obsnum_end, receivers, y_
                           type='date',
                           tickformat='%H:%M:%S',
                           title = 'Time of Day (UTC)',
-                          range=[pd.to_datetime('00:00:00').strftime('%Y-%m-%d %H:%M:%S'),
-                                 pd.to_datetime('12:00:00').strftime('%Y-%m-%d %H:%M:%S')]),
+                          range=[f'{today} 00:00:00', f'{today} 12:00:00']),
                       # yaxis=dict(title=f'{modal_type.capitalize()} (mm)'),
                       )
+    return fig.to_json()
+
+@metrics.timed('make_compare_plot')
+def make_compare_plot(modal_type, dates, obsnum_start, obsnum_end, receivers, y_axis):
+    today = utc_now().date()
+    fig = json.loads(compare_skeleton(today))
+    if isinstance(dates, str):
+        dates = [dates]
+    # All selected days are loaded in one pass and split by a single groupby
+    df_all = get_df_dates(modal_type, dates, ['ObsNum', 'Receiver', 'DateTime', 'TimeOfDay'] + list(y_axis),
+                          receivers, obsnum_start, obsnum_end)
+    # Every day is drawn over today, at the time of day parsed at ingest
+    midnight_ms = pd.Timestamp(today).value / 1e6
+    groups = {}
+    if not df_all.empty:
+        groups = {file_date: df for file_date, df in df_all.groupby('file_date', sort=False)}
+    for date in dates:
+        df = groups.get(pd.to_datetime(date).normalize())
+        if df is None or df.empty:
+            continue
+        x = plotting.encode(midnight_ms + plotting.time_of_day(df) * 1000)
+        for y in y_axis:
+            fig['data'].append(dict(type='scatter', x=x, y=plotting.encode(df[y]), mode='lines+markers',
+                                    name=f'{date} {y}'))
     return fig
 
+def get_compare_plot(modal_type, dates, obsnum_start, obsnum_end, receivers, y_axis):
+    # make_compare_plot through the figure cache, the figure is returned as a plain dict
+    refresh_data()
+    key = ('compare', 'astigmatism' if modal_type == 'astig' else modal_type, as_tuple(dates),
+           normalize_obsnum(obsnum_start), normalize_obsnum(obsnum_end), tuple(sorted(receivers or ())),
+           as_tuple(y_axis))
+    return figure_cache.get_figure(key, lambda: make_compare_plot(
+        modal_type, dates, obsnum_start, obsnum_end, receivers, y_axis))
+
 
 
 # def make_compare_plot(name, start_date, end_date, compare_start_date, compare_end_date, obsnum_start, obsnum_end, receivers, x_axis, y_axis):
@@ -554,8 +775,8 @@ def create_date_selector(name):
                     display_format='YYYY-MM-DD',
                     start_date_placeholder_text='Start Date',
                     end_date_placeholder_text='End Date',
-                    start_date=datetime.now() - timedelta(days=7),
-                    end_date=datetime.now(),
+                    start_date=utc_now() - timedelta(days=7),
+                    end_date=utc_now(),
                     persistence=True,  # Enable persistence if required
                     persistence_type='session',  # Persist in session
                     className='datepicker__input'
@@ -578,17 +799,20 @@ def plot_content(name):
             dbc.Col(dcc.Dropdown(id=f'{name}-y-axis', multi=True, options=get_fields(name),
                                  value=value)),
         ],className='mb-1'),
-        dcc.Loading(dcc.Graph(figure=go.Figure(), id=f'{name}-plot'))], style=PLOT_STYLE),
+        dcc.Loading(dcc.Graph(figure=go.Figure(), id=f'{name}-plot')),
+        html.Div(id=f'{name}-stats', style={'overflowX': 'auto'})], style=PLOT_STYLE),
         create_compare_modal(f'{name}')
     ])
 
-plots = html.Div(dbc.Row([
-    dbc.Col(plot_content('astig'), width=4),
-    dbc.Col(plot_content('focus'), width=4),
-    dbc.Col(plot_content('pointing'), width=4),]),
-)
+def create_plots():
+    return html.Div(dbc.Row([
+        dbc.Col(plot_content('astig'), width=4),
+        dbc.Col(plot_content('focus'), width=4),
+        dbc.Col(plot_content('pointing'), width=4),]),
+    )
 
-same_setting = html.Div(
+def create_same_setting():
+    return html.Div(
     [
         dbc.Row([
             dbc.Col(create_date_selector('same'), width='auto'),
@@ -601,7 +825,7 @@ same_setting = html.Div(
 
                               ), width='auto'),
             dbc.Col(dbc.Label('Receivers'), width='auto'),
-            dbc.Col(dbc.Checklist(id='same-receiver', options=get_receivers('pointing'), value=get_receivers('pointing'), inline=True)),
+            dbc.Col(dbc.Checklist(id='same-receiver', options=get_receivers('same'), value=get_receivers('same'), inline=True)),
             dbc.Col(dbc.Label('x-axis'), width='auto'),
             dbc.Col(dcc.Dropdown(id='same-x-axis', options=pointing_x_axis, value='ObsNum'), width='2'),
         ]),
@@ -0,0 +1,134 @@
+# Timing spans and counters of the data path, served in the Prometheus text format on
+# /lmtqldb/metrics. Callbacks wrapped with timed_callback also sum the spans of their
+# own request and log them when it took at least config.slow_request_seconds.
+# Spans run on the io pool threads count for the request that submitted them, so
+# stages read in parallel can sum to more than the callback took.
+# Work done in the io_processes worker processes is not counted.
+import functools
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+import config
+
+lock = threading.Lock()
+# stage -> [calls, total seconds, max seconds]
+stages = {}
+counters = {
+    'files_read': 0,
+    'rows_loaded': 0,
+    'bytes_read': 0,
+    'sidecars_built': 0,
+    'callback_errors': 0,
+}
+# name -> function returning a dict of gauges, e.g. cache statistics
+collectors = {}
+local = threading.local()
+
+
+def add(**changes):
+    with lock:
+        for name, change in changes.items():
+            counters[name] = counters.get(name, 0) + change
+
+
+def register_collector(name, collect):
+    collectors[name] = collect
+
+
+def record(stage, seconds):
+    with lock:
+        entry = stages.setdefault(stage, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        # Under the lock, since the io pool threads of a request add to it at once
+        request = getattr(local, 'request', None)
+        if request is not None:
+            request[stage] = request.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    # Decorator form of span
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log_slow_request(message):
+    if config.slow_request_log:
+        with open(config.slow_request_log, 'a') as f:
+            f.write(message + '\n')
+    else:
+        print(message)
+
+
+def timed_callback(fn=None, name=None):
+    # Times a Dash callback and logs it with its inputs and stage breakdown when slow.
+    # Callbacks made by a factory once per modal pass their own name,
+    # @timed_callback(name=...), others are known by their function name
+    if fn is None:
+        return lambda fn: timed_callback(fn, name)
+    name = name or fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer = getattr(local, 'request', None)
+        local.request = {}
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            request, local.request = local.request, outer
+            record(f'callback:{name}', seconds)
+            if config.slow_request_seconds is not None and seconds >= config.slow_request_seconds:
+                breakdown = ', '.join(f'{stage}={value:.3f}s' for stage, value in request.items())
+                inputs = repr(args)[:500]
+                log_slow_request(f"{time.strftime('%Y-%m-%d %H:%M:%S')} slow callback {name} "
+                                 f"{seconds:.3f}s inputs={inputs} stages: {breakdown}")
+    return wrapper
+
+
+def record_error(callback_name, error):
+    # Callbacks turn exceptions into no_update, this keeps them visible
+    add(callback_errors=1)
+    print(f"Error in {callback_name}: {error}")
+    traceback.print_exception(error)
+
+
+def render():
+    lines = [
+        '# TYPE lmtqldb_stage_calls_total counter',
+        '# TYPE lmtqldb_stage_seconds_total counter',
+        '# TYPE lmtqldb_stage_seconds_max gauge',
+    ]
+    with lock:
+        stage_items = sorted(stages.items())
+        counter_items = sorted(counters.items())
+    for stage, (calls, total, maximum) in stage_items:
+        lines.append(f'lmtqldb_stage_calls_total{{stage="{stage}"}} {calls}')
+        lines.append(f'lmtqldb_stage_seconds_total{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'lmtqldb_stage_seconds_max{{stage="{stage}"}} {maximum:.6f}')
+    for name, value in counter_items:
+        lines.append(f'# TYPE lmtqldb_{name}_total counter')
+        lines.append(f'lmtqldb_{name}_total {value}')
+    for collector_name, collect in sorted(collectors.items()):
+        for name, value in sorted(collect().items()):
+            if isinstance(value, (int, float)):
+                lines.append(f'# TYPE lmtqldb_{collector_name}_{name} gauge')
+                lines.append(f'lmtqldb_{collector_name}_{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,178 @@
+# Helpers to keep large scatter plots cheap to build, send and render.
+# Figures are built as plain dicts with the arrays in plotly's typed array form
+# (base64 data plus dtype) and datetimes as epoch milliseconds on 'date' axes,
+# instead of validated go.Figure objects.
+import base64
+import functools
+import json
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+import config
+
+# numpy dtypes plotly.js reads as typed arrays
+typed_array_dtypes = {'float64': 'f8', 'float32': 'f4', 'int32': 'i4', 'int16': 'i2', 'int8': 'i1',
+                      'uint32': 'u4', 'uint16': 'u2', 'uint8': 'u1'}
+
+
+def as_numbers(values):
+    # datetimes are binned on their int64 nanoseconds
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').view('int64').astype('float64')
+    return values.astype('float64')
+
+
+def minmax_indices(x, y, max_points):
+    # Keep the min and max y of each x bin, which preserves the envelope and outliers
+    n = len(y)
+    if n <= max_points:
+        return np.arange(n)
+    if not (np.issubdtype(y.dtype, np.number) and
+            (np.issubdtype(x.dtype, np.number) or np.issubdtype(x.dtype, np.datetime64))):
+        return np.linspace(0, n - 1, max_points).astype(int)
+
+    x = as_numbers(x)
+    y = y.astype('float64')
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(valid) <= max_points:
+        return valid
+    x, y = x[valid], y[valid]
+
+    n_bins = max(max_points // 2, 1)
+    x_min, x_max = x.min(), x.max()
+    if x_max > x_min:
+        bins = ((x - x_min) / (x_max - x_min) * n_bins).astype('int64').clip(0, n_bins - 1)
+    else:
+        bins = np.zeros(len(x), dtype='int64')
+    order = np.lexsort((y, bins))
+    sorted_bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    ends = np.r_[starts[1:], len(order)] - 1
+    return valid[np.unique(np.concatenate([order[starts], order[ends]]))]
+
+
+def encode(values):
+    # Array values of a trace, as a typed array where plotly.js supports one
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = values.astype('datetime64[ms]')
+        missing = np.isnat(values)
+        values = values.astype('int64').astype('float64')
+        values[missing] = np.nan
+    elif np.issubdtype(values.dtype, np.bool_):
+        values = values.astype('uint8')
+    elif values.dtype.kind in 'iu':
+        # The smallest integer type holding every value, as plotly.py does
+        low, high = (values.min(), values.max()) if len(values) else (0, 0)
+        for name in ['int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'float64']:
+            if name == 'float64' or (np.iinfo(name).min <= low and high <= np.iinfo(name).max):
+                values = values.astype(name)
+                break
+    code = typed_array_dtypes.get(values.dtype.name)
+    if code is None:
+        return values.tolist()
+    data = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<'))
+    return {'dtype': code, 'bdata': base64.b64encode(data.tobytes()).decode('ascii')}
+
+
+def is_datetime(values):
+    return np.issubdtype(np.asarray(values).dtype, np.datetime64)
+
+
+def time_of_day(df):
+    # Seconds since midnight of every row, from the TimeOfDay column parsed at ingest.
+    # Rows stored before it existed fall back to the int64 DateTime
+    if 'TimeOfDay' in df.columns:
+        seconds = df['TimeOfDay'].to_numpy(dtype='float64', na_value=np.nan)
+    else:
+        seconds = np.full(len(df), np.nan)
+    missing = np.isnan(seconds)
+    if missing.any() and 'DateTime' in df.columns:
+        nanoseconds = df['DateTime'].to_numpy(dtype='datetime64[ns]').view('int64')
+        from_datetime = (nanoseconds % (86400 * 10**9)) / 1e9
+        from_datetime[df['DateTime'].isna().to_numpy()] = np.nan
+        seconds = np.where(missing, from_datetime, seconds)
+    return seconds
+
+
+@functools.lru_cache(maxsize=None)
+def subplots_skeleton(rows):
+    # JSON of the empty make_plot figure with rows subplots, built once per row count
+    if rows == 1:
+        fig = make_subplots(rows=1, cols=1)
+    else:
+        fig = make_subplots(rows=rows, cols=1, row_heights=[1] * rows, vertical_spacing=0.05, shared_xaxes=True)
+        fig.update_layout(height=rows * 200, showlegend=False, margin=dict(l=50, r=50, t=50, b=50))
+    return fig.to_json()
+
+
+def subplots_figure(rows):
+    # A fresh copy of the skeleton, with the axis names of every row
+    figure = json.loads(subplots_skeleton(rows))
+    axes = [('xaxis' if row == 1 else f'xaxis{row}', 'yaxis' if row == 1 else f'yaxis{row}')
+            for row in range(1, rows + 1)]
+    return figure, axes
+
+
+@functools.lru_cache(maxsize=None)
+def message_skeleton(text):
+    fig = go.Figure()
+    fig.add_annotation(text=text, showarrow=False, xref='paper', yref='paper', x=0.5, y=0.5)
+    return fig.to_json()
+
+
+def message_figure(text):
+    # An empty figure showing text, e.g. 'No data selected'
+    return json.loads(message_skeleton(text))
+
+
+def filter_x_range(df, x_axis, x_range):
+    # Rows of df whose x value lies in the visible x_range of a zoomed plot
+    x = df[x_axis]
+    if pd.api.types.is_datetime64_any_dtype(x):
+        x_start, x_end = pd.to_datetime(x_range[0]), pd.to_datetime(x_range[1])
+    else:
+        x_start, x_end = float(x_range[0]), float(x_range[1])
+    return df[(x >= x_start) & (x <= x_end)]
+
+
+def make_scatter(x, y, **kwargs):
+    # Scatter trace dict, downsampled above config.plot_max_points and drawn with WebGL
+    # above config.webgl_min_points
+    x, y = np.asarray(x), np.asarray(y)
+    indices = minmax_indices(x, y, config.plot_max_points)
+    if len(indices) < len(x):
+        x, y = x[indices], y[indices]
+    trace_type = 'scattergl' if len(x) > config.webgl_min_points else 'scatter'
+    return dict(kwargs, type=trace_type, x=encode(x), y=encode(y))
+
+
+def make_band(x, mean, low, high, name):
+    # Mean line over a shaded min/max band, for rolled up data
+    x = encode(x)
+    return [
+        dict(type='scatter', x=x, y=encode(low), mode='lines', line=dict(width=0), showlegend=False,
+             name=f'{name} min'),
+        dict(type='scatter', x=x, y=encode(high), mode='lines', line=dict(width=0), fill='tonexty',
+             fillcolor='rgba(23, 162, 184, 0.25)', showlegend=False, name=f'{name} max'),
+        dict(type='scatter', x=x, y=encode(mean), mode='lines', line=dict(color='#17a2b8'), name=f'{name} mean'),
+    ]
+
+
+def relayout_x_range(relayout_data):
+    # (changed, x_range) from a graph's relayoutData. x_range is None when the
+    # x axis was reset to autorange, changed is False when x did not change at all
+    if not relayout_data:
+        return False, None
+    for key, value in relayout_data.items():
+        axis, _, prop = key.partition('.')
+        if not axis.startswith('xaxis'):
+            continue
+        if prop == 'autorange' and value:
+            return True, None
+        if prop == 'range':
+            return True, list(value)
+        if prop == 'range[0]' and f'{axis}.range[1]' in relayout_data:
+            return True, [value, relayout_data[f'{axis}.range[1]']]
+    return False, None
@@ -0,0 +1,240 @@
+# Hourly and daily rollups of every numeric field per receiver, kept by the ingest worker.
+# Each bucket holds count, sum, sum of squares, min and max of a field, which merge
+# across files and receivers, so long range trend plots read a few thousand rows
+# instead of every observation. The sketch table adds, for the config.summary_fields,
+# the percentiles of every day and receiver and the sums a linear fit over time needs,
+# which summaries.py merges into range statistics. The tables are persisted as
+# cache_dir/rollups/<folder key>.<freq or sketch>.feather with a source column naming the
+# data file each row came from, so only added or changed files are summarized again.
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+import config
+import filecache
+import indexer
+import iopool
+
+# Bump when the rollup contents change so that the tables are rebuilt
+ROLLUP_VERSION = 2
+data_folders = ['astigmatism', 'focus', 'pointing']
+freqs = {'hourly': 'h', 'daily': 'D'}
+table_names = list(freqs) + ['sketch']
+stats = ['count', 'sum', 'sumsq', 'min', 'max']
+# Percentiles kept per day, receiver and field, min and max included. Days with fewer
+# values keep the values themselves, padded with NaN
+sketch_levels = np.linspace(0, 1, 101)
+sketch_columns = [f'q{i}' for i in range(len(sketch_levels))]
+# Numeric columns that are not measurements
+skipped_columns = ['ObsNum', 'TimeOfDay']
+
+lock = threading.Lock()
+# (folder key, freq) -> (mtime_ns, table) of the tables read by query()
+tables = {}
+
+
+def rollup_dir():
+    return os.path.join(config.cache_dir, 'rollups')
+
+
+def table_path(folder_key, freq):
+    return os.path.join(rollup_dir(), f'{folder_key}.{freq}.feather')
+
+
+def sources_path(folder_key):
+    return os.path.join(rollup_dir(), f'{folder_key}.json')
+
+
+def field_columns(df):
+    return [column for column in df.columns
+            if column not in skipped_columns and pd.api.types.is_numeric_dtype(df[column])
+            and not pd.api.types.is_bool_dtype(df[column])]
+
+
+def merge(table, keys):
+    # Partials grouped by keys: counts and sums add up, min and max of the minima and maxima
+    grouped = table.groupby(keys, observed=True, sort=True)
+    parts = []
+    for stat in stats:
+        columns = [column for column in table.columns if column.rpartition('.')[2] == stat]
+        part = grouped[columns]
+        parts.append(part.min() if stat == 'min' else part.max() if stat == 'max' else part.sum())
+    return pd.concat(parts, axis=1)
+
+
+def aggregate(df, fields):
+    # Hourly partials of the fields of df per receiver, one column per field and statistic
+    values = df[fields].astype('float64')
+    keys = [df['DateTime'].dt.floor(freqs['hourly']).rename('bucket'), df['Receiver'].rename('Receiver')]
+    grouped = values.groupby(keys, observed=True, sort=True)
+    return pd.concat([grouped.count().add_suffix('.count'), grouped.sum().add_suffix('.sum'),
+                      (values ** 2).groupby(keys, observed=True, sort=True).sum().add_suffix('.sumsq'),
+                      grouped.min().add_suffix('.min'), grouped.max().add_suffix('.max')], axis=1).reset_index()
+
+
+def sketch(df, fields):
+    # Per day, receiver and field: count, percentiles and the sums of x, x*x, f, f*f and
+    # f*x with f the fraction of the day, so fits over any range of days merge exactly
+    rows = []
+    day = df['DateTime'].dt.floor(freqs['daily'])
+    fraction = ((df['DateTime'] - day) / pd.Timedelta(days=1)).to_numpy()
+    for (bucket, receiver), index in df.groupby([day.rename('bucket'), 'Receiver'], observed=True,
+                                               sort=True).indices.items():
+        for field in fields:
+            x = df[field].to_numpy(dtype='float64')[index]
+            f = fraction[index]
+            valid = np.isfinite(x)
+            x, f = x[valid], f[valid]
+            if len(x) == 0:
+                continue
+            row = {'bucket': bucket, 'Receiver': receiver, 'field': field, 'count': len(x),
+                   'sumx': x.sum(), 'sumxx': (x * x).sum(), 'sumf': f.sum(), 'sumff': (f * f).sum(),
+                   'sumfx': (f * x).sum()}
+            if len(x) <= len(sketch_levels):
+                points = np.full(len(sketch_levels), np.nan)
+                points[:len(x)] = np.sort(x)
+            else:
+                points = np.quantile(x, sketch_levels)
+            row.update(zip(sketch_columns, points))
+            rows.append(row)
+    return pd.DataFrame(rows, columns=['bucket', 'Receiver', 'field', 'count', 'sumx', 'sumxx', 'sumf', 'sumff',
+                                       'sumfx'] + sketch_columns)
+
+
+def summarize_file(folder_key, folder_path, filename):
+    # Hourly and daily rollups of one data file, None when it has nothing to roll up
+    try:
+        df = filecache.read_file(folder_key, folder_path, filename)
+    except Exception as e:
+        print(f"Error rolling up file {filename}: {e}")
+        return None
+    if df.empty or 'DateTime' not in df.columns:
+        return None
+    fields = field_columns(df)
+    if not fields:
+        return None
+    df = df.assign(Receiver=df['Receiver'].astype(str) if 'Receiver' in df.columns else '')
+    df = df[df['DateTime'].notna()]
+    hourly = aggregate(df, fields)
+    daily = merge(hourly, [hourly['bucket'].dt.floor(freqs['daily']), 'Receiver']).reset_index()
+    sketches = sketch(df, [field for field in config.summary_fields.get(folder_key, []) if field in fields])
+    return {'hourly': hourly.assign(source=filename), 'daily': daily.assign(source=filename),
+            'sketch': sketches.assign(source=filename)}
+
+
+def read_sources(folder_key):
+    try:
+        with open(sources_path(folder_key)) as f:
+            sources = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error reading rollup sources of {folder_key}: {e}")
+        return {}
+    if sources.get('version') != ROLLUP_VERSION:
+        return {}
+    return sources.get('files', {})
+
+
+def read_table(folder_key, freq):
+    try:
+        return pd.read_feather(table_path(folder_key, freq))
+    except FileNotFoundError:
+        return None
+
+
+def write_table(folder_key, freq, table):
+    path = table_path(folder_key, freq)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    table.reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def update_folder(folder_key):
+    # Roll up the new and changed files of the folder's index, drop removed ones
+    index_df = indexer.get_index(folder_key).index_df
+    expected = {row.filename: [int(row.mtime_ns), int(row.size)]
+                for row in index_df.itertuples() if not pd.isna(row.mtime_ns)}
+    sources = read_sources(folder_key)
+    if sources == expected:
+        return False
+    todo = [filename for filename, version in expected.items() if sources.get(filename) != version]
+    keep = set(expected) - set(todo)
+    folder_path = config.folder_paths[folder_key]
+    results = iopool.map(summarize_file, [folder_key] * len(todo), [folder_path] * len(todo), todo, background=True)
+    os.makedirs(rollup_dir(), exist_ok=True)
+    for freq in table_names:
+        table = read_table(folder_key, freq) if sources else None
+        parts = []
+        if table is not None:
+            parts.append(table[table['source'].isin(keep)])
+        parts += [result[freq] for result in results if result is not None]
+        parts = [part for part in parts if not part.empty]
+        table = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['bucket', 'Receiver', 'source'])
+        table = table.sort_values(by='bucket', kind='stable')
+        write_table(folder_key, freq, table)
+    indexer.write_file_atomic(sources_path(folder_key), json.dumps({'version': ROLLUP_VERSION, 'files': expected}))
+    return True
+
+
+def update():
+    # Called by the ingest worker after the indexes were updated
+    changed = False
+    for folder_key in data_folders:
+        try:
+            if update_folder(folder_key):
+                changed = True
+        except Exception as e:
+            print(f"Error updating rollups of {folder_key}: {e}")
+    return changed
+
+
+def get_table(folder_key, freq):
+    # The persisted table, read again when the ingest worker replaced it
+    path = table_path(folder_key, freq)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with lock:
+        cached = tables.get((folder_key, freq))
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+    try:
+        table = pd.read_feather(path)
+    except Exception as e:
+        print(f"Error reading rollups {path}: {e}")
+        return None
+    with lock:
+        tables[(folder_key, freq)] = (mtime_ns, table)
+    return table
+
+
+def query(folder_key, freq, start_date, end_date, fields, receivers=None):
+    # Per bucket count, mean, std, min and max of fields over the selected receivers,
+    # as columns '<field>.<stat>'. None when a field has no rollup
+    table = get_table(folder_key, freq)
+    if table is None or any(f'{field}.sum' not in table.columns for field in fields):
+        return None
+    buckets = table['bucket'].to_numpy(dtype='datetime64[ns]')
+    lo = np.searchsorted(buckets, np.datetime64(pd.Timestamp(start_date).floor('D'), 'ns'), side='left')
+    hi = np.searchsorted(buckets, np.datetime64(pd.Timestamp(end_date).floor('D') + pd.Timedelta(days=1), 'ns'),
+                         side='left')
+    rows = table.iloc[lo:hi]
+    if receivers:
+        rows = rows[rows['Receiver'].isin(receivers)]
+    rows = rows[['bucket'] + [f'{field}.{stat}' for field in fields for stat in stats]]
+    merged = merge(rows, 'bucket')
+    result = pd.DataFrame({'bucket': merged.index})
+    for field in fields:
+        count = merged[f'{field}.count'].to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = merged[f'{field}.sum'].to_numpy() / count
+            variance = merged[f'{field}.sumsq'].to_numpy() / count - mean ** 2
+        result[f'{field}.count'] = count
+        result[f'{field}.mean'] = mean
+        result[f'{field}.std'] = np.sqrt(np.clip(variance, 0, None))
+        result[f'{field}.min'] = merged[f'{field}.min'].to_numpy()
+        result[f'{field}.max'] = merged[f'{field}.max'].to_numpy()
+    return result
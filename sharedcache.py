@@ -0,0 +1,151 @@
+# Cache tier shared by every process serving the app, behind the in-process caches of
+# cache.py. Loaded DataFrames are stored as Arrow IPC streams and figures as JSON, so a
+# gunicorn worker finds what another worker (or the process before a restart) built.
+# Entries are bytes under a string key that starts with the ingest generation.
+#   'files': one file per entry in a directory, on a tmpfs such as /dev/shm it is
+#            shared memory. Bounded by config.shared_cache_max_bytes
+#   'redis': an external cache server at config.shared_cache_url (needs the redis
+#            package), bounded by the server's own memory policy
+# Another server only needs a class with the get/put/set_generation methods below.
+import glob
+import os
+import time
+import config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class FileStore:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.generation = None
+        # Bytes in the directory when it was last counted plus those put since, None
+        # until it is counted. Other processes' puts are seen at the next count
+        self.total_bytes = None
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Reads keep an entry from being evicted first
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing shared cache entry {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self.total_bytes is None:
+            self.evict()
+        else:
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Count the directory and, when it is over max_bytes, remove the least recently
+        # used entries until it fits three quarters of it, so it is not counted every put
+        entries = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory), '*')):
+            if path.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * 3 // 4:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.total_bytes = total
+
+    def set_generation(self, generation):
+        # Entries of other generations are stale, whichever process wrote them
+        if generation == self.generation:
+            return
+        self.generation = generation
+        self.total_bytes = None
+        for path in glob.glob(os.path.join(glob.escape(self.directory), '*')):
+            if not os.path.basename(path).startswith(f'{generation}-'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class RedisStore:
+    def __init__(self, url, ttl):
+        if redis is None:
+            raise ImportError("shared_cache = 'redis' needs the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        # Last time the server failed, it is not asked again for a while
+        self.failed_at = 0
+
+    def available(self):
+        return time.monotonic() - self.failed_at > 30
+
+    def get(self, key):
+        if not self.available():
+            return None
+        try:
+            return self.client.get(f'lmtqldb:{key}')
+        except redis.RedisError as e:
+            print(f"Error reading shared cache entry {key}: {e}")
+            self.failed_at = time.monotonic()
+            return None
+
+    def put(self, key, data):
+        if not self.available():
+            return
+        try:
+            self.client.set(f'lmtqldb:{key}', bytes(data), ex=self.ttl)
+        except redis.RedisError as e:
+            print(f"Error writing shared cache entry {key}: {e}")
+            self.failed_at = time.monotonic()
+
+    def set_generation(self, generation):
+        # Keys of old generations are never read again and expire after ttl
+        pass
+
+
+def create_store():
+    # The store selected by config.shared_cache, None keeps every cache in-process
+    if config.shared_cache == 'files':
+        directory = config.shared_cache_dir or os.path.join(config.cache_dir, 'shared')
+        return FileStore(directory, config.shared_cache_max_bytes)
+    if config.shared_cache == 'redis':
+        try:
+            return RedisStore(config.shared_cache_url, config.shared_cache_ttl)
+        except ImportError as e:
+            print(f"Error creating the shared cache: {e}")
+            return None
+    return None
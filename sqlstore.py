@@ -0,0 +1,216 @@
+# Optional SQLite store of all QL data, selected with config.storage_backend = 'sqlite'.
+# The ingest worker copies every indexed astigmatism, focus and pointing file into one
+# table per type and the tel lookup into the tel table. Queries push the date, ObsNum
+# and receiver predicates into SQL and join tel there. Until every file of a type
+# has been ingested once query() returns None and the CSV path is used instead.
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import config
+import filecache
+import indexer
+import tellookup
+
+data_tables = ['astigmatism', 'focus', 'pointing']
+# Bookkeeping columns added to every data table, not returned by query()
+internal_columns = ['source', 'file_date']
+indexed_columns = ['ObsNum', 'DateTime', 'Receiver']
+
+local = threading.local()
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect():
+    # One connection per thread, WAL lets readers run while the ingest worker writes
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.path != config.sqlite_path:
+        os.makedirs(os.path.dirname(config.sqlite_path), exist_ok=True)
+        conn = sqlite3.connect(config.sqlite_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS files (
+            folder_key TEXT, filename TEXT, mtime_ns INTEGER, size INTEGER,
+            PRIMARY KEY (folder_key, filename))''')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS tel (
+            ObsNum INTEGER PRIMARY KEY, Telescope_AzDesPos REAL, Telescope_ElDesPos REAL)''')
+        local.conn = conn
+        local.path = config.sqlite_path
+    return conn
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({quote(table)})')]
+
+
+def sql_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def create_index(conn, table, column):
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {quote(f"{table}_{column}")} ON {quote(table)} ({quote(column)})')
+
+
+def ensure_table(conn, table, df):
+    columns = table_columns(conn, table)
+    if not columns:
+        conn.execute(f'CREATE TABLE {quote(table)} (source TEXT, file_date INTEGER)')
+        columns = internal_columns[:]
+        for column in internal_columns:
+            create_index(conn, table, column)
+    # Files may bring columns the table does not have yet
+    for column in df.columns:
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {sql_type(df[column].dtype)}')
+            columns.append(column)
+            if column in indexed_columns:
+                create_index(conn, table, column)
+
+
+def insert_file(conn, table, folder_path, filename, file_date):
+    df = filecache.read_file(table, folder_path, filename)
+    if table_columns(conn, table):
+        conn.execute(f'DELETE FROM {quote(table)} WHERE source = ?', (filename,))
+    if df.empty:
+        return
+    ensure_table(conn, table, df)
+    values = {}
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values[column] = series.astype('datetime64[ns]').astype('int64').where(series.notna(), None)
+        else:
+            values[column] = series.astype(object).where(series.notna(), None)
+    rows = pd.DataFrame(values)
+    rows.insert(0, 'file_date', pd.Timestamp(file_date).value)
+    rows.insert(0, 'source', filename)
+    column_list = ', '.join(quote(column) for column in rows.columns)
+    placeholders = ', '.join('?' for _ in rows.columns)
+    conn.executemany(f'INSERT INTO {quote(table)} ({column_list}) VALUES ({placeholders})',
+                     rows.itertuples(index=False, name=None))
+
+
+def synced_key(table):
+    return f'synced_{table}'
+
+
+def sync_table(conn, table):
+    # Copy new and changed files of the table's index, drop rows of removed files.
+    # A pass that leaves no file of the index behind marks the table as synced
+    index_df = indexer.get_index(table).index_df
+    known = {filename: (mtime_ns, size) for filename, mtime_ns, size in conn.execute(
+        'SELECT filename, mtime_ns, size FROM files WHERE folder_key = ?', (table,))}
+    folder_path = config.folder_paths[table]
+    changed = False
+    pending = False
+    current = set()
+    for row in index_df.itertuples():
+        current.add(row.filename)
+        if pd.isna(row.mtime_ns):
+            # Not summarized by the indexer yet
+            pending = True
+            continue
+        if known.get(row.filename) == (int(row.mtime_ns), int(row.size)):
+            continue
+        with conn:
+            insert_file(conn, table, folder_path, row.filename, row.file_date)
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                         (table, row.filename, int(row.mtime_ns), int(row.size)))
+        changed = True
+    for filename in set(known) - current:
+        with conn:
+            if table_columns(conn, table):
+                conn.execute(f'DELETE FROM {quote(table)} WHERE source = ?', (filename,))
+            conn.execute('DELETE FROM files WHERE folder_key = ? AND filename = ?', (table, filename))
+        changed = True
+    if not pending and not index_df.empty and not is_synced(conn, table):
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, 1)', (synced_key(table),))
+        changed = True
+    return changed
+
+
+def is_synced(conn, table):
+    return conn.execute('SELECT 1 FROM meta WHERE key = ?', (synced_key(table),)).fetchone() is not None
+
+
+def sync_tel(conn):
+    with tellookup.lock:
+        tellookup.load()
+        keys, az, el, mtime_ns = (tellookup.lookup[key] for key in ['keys', 'az', 'el', 'mtime_ns'])
+    row = conn.execute("SELECT value FROM meta WHERE key = 'tel_lookup_mtime_ns'").fetchone()
+    if mtime_ns is None or (row is not None and row[0] == mtime_ns):
+        return False
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO tel VALUES (?, ?, ?)',
+                         zip(keys.tolist(), az.tolist(), el.tolist()))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('tel_lookup_mtime_ns', ?)", (mtime_ns,))
+    return True
+
+
+def sync():
+    # Called by the ingest worker after the indexes were updated
+    conn = connect()
+    changed = sync_tel(conn)
+    for table in data_tables:
+        if sync_table(conn, table):
+            changed = True
+    return changed
+
+
+def query(name, start_date, end_date, columns=None, receivers=None, obsnum_start=None, obsnum_end=None,
+          dates=None):
+    # Same result as the CSV path of get_df, or None when the store cannot answer.
+    # With dates the rows of those days are returned instead, tagged with their file_date
+    try:
+        conn = connect()
+        # A partly copied type would answer with days missing
+        if not is_synced(conn, name):
+            return None
+        available = [column for column in table_columns(conn, name) if column not in internal_columns]
+        if not available:
+            return None
+        if columns is not None:
+            columns = set(columns)
+            available = [column for column in available if column in columns]
+        select = ', '.join(f'm.{quote(column)}' for column in available)
+        if dates is None:
+            sql = (f'SELECT {select}, t.Telescope_AzDesPos, t.Telescope_ElDesPos FROM {quote(name)} m '
+                   f'JOIN tel t ON m.ObsNum = t.ObsNum WHERE m.file_date BETWEEN ? AND ?')
+            params = [pd.Timestamp(start_date).value, pd.Timestamp(end_date).value]
+        else:
+            sql = (f'SELECT {select}, m.file_date, t.Telescope_AzDesPos, t.Telescope_ElDesPos FROM {quote(name)} m '
+                   f"JOIN tel t ON m.ObsNum = t.ObsNum WHERE m.file_date IN ({', '.join('?' for _ in dates)})")
+            params = [pd.Timestamp(date).value for date in dates]
+        if receivers:
+            sql += f" AND m.Receiver IN ({', '.join('?' for _ in receivers)})"
+            params += list(receivers)
+        if obsnum_start is not None:
+            sql += ' AND m.ObsNum >= ?'
+            params.append(obsnum_start)
+        if obsnum_end is not None:
+            sql += ' AND m.ObsNum <= ?'
+            params.append(obsnum_end)
+        sql += ' ORDER BY m.file_date, m.rowid'
+        df = pd.read_sql_query(sql, conn, params=params)
+    except Exception as e:
+        print(f"Error querying {name} from {config.sqlite_path}: {e}")
+        return None
+
+    if df.empty:
+        return pd.DataFrame()
+    for column in ['DateTime', 'file_date']:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], unit='ns')
+    telescope = df[['Telescope_AzDesPos', 'Telescope_ElDesPos']]
+    df = filecache.compact_dtypes(df.drop(columns=telescope.columns))
+    df[telescope.columns] = telescope.to_numpy(dtype=np.float64)
+    return df
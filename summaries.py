@@ -0,0 +1,115 @@
+# Per receiver statistics of the plotted fields for the statistics panel: count, mean,
+# median, MAD, sigma clipped mean, outlier count and linear drift per day.
+# Fields with daily sketches in the rollups (config.summary_fields) are merged from them,
+# at most a hundred and one values per day and receiver, so a year costs a merge of the
+# daily partials instead of a scan of every observation. Count, mean and drift are
+# exact, the others too on days with up to 101 observations and approximate on busier
+# days, where every percentile stands for a hundredth of the day.
+import numpy as np
+import pandas as pd
+import config
+import rollups
+
+columns = ['Receiver', 'field', 'count', 'mean', 'median', 'mad', 'clipped_mean', 'outliers', 'drift_per_day']
+# MAD to standard deviation of a normal distribution
+mad_scale = 1.4826
+clip_iterations = 5
+
+
+def weighted_median(x, w):
+    # x sorted
+    cumulative = np.cumsum(w)
+    return x[np.searchsorted(cumulative, cumulative[-1] / 2)]
+
+
+def clipped_mean(x, w, sigma):
+    # Mean of the sorted values x within sigma standard deviations of the median,
+    # clipped again until no value changes side
+    keep = np.ones(len(x), dtype=bool)
+    for _ in range(clip_iterations):
+        center = weighted_median(x[keep], w[keep])
+        mean = np.average(x[keep], weights=w[keep])
+        std = np.sqrt(np.average((x[keep] - mean) ** 2, weights=w[keep]))
+        clipped = np.abs(x - center) <= sigma * std
+        if (clipped == keep).all():
+            break
+        keep = clipped
+    return np.average(x[keep], weights=w[keep])
+
+
+def drift(count, sumt, sumtt, sumx, sumtx):
+    # Slope of the least squares line through (days, value)
+    denominator = count * sumtt - sumt ** 2
+    if count < 2 or denominator <= 1e-12 * count * sumtt:
+        return np.nan
+    return (count * sumtx - sumt * sumx) / denominator
+
+
+def point_stats(x, w):
+    # Median, MAD, clipped mean and outlier count of values x weighted by w observations
+    order = np.argsort(x, kind='stable')
+    x, w = x[order], w[order]
+    median = weighted_median(x, w)
+    deviation = np.abs(x - median)
+    order = np.argsort(deviation, kind='stable')
+    mad = weighted_median(deviation[order], w[order])
+    outliers = w[deviation > config.outlier_mads * mad_scale * mad].sum() if mad > 0 else 0
+    return median, mad, clipped_mean(x, w, config.clip_sigma), outliers
+
+
+def from_sketches(folder_key, start_date, end_date, fields, receivers=None):
+    # Statistics of the fields with sketches, None when the rollups have none yet
+    table = rollups.get_table(folder_key, 'sketch')
+    if table is None or 'field' not in table.columns:
+        return None
+    buckets = table['bucket'].to_numpy(dtype='datetime64[ns]')
+    start_date = pd.Timestamp(start_date).floor('D')
+    lo = np.searchsorted(buckets, np.datetime64(start_date, 'ns'), side='left')
+    hi = np.searchsorted(buckets, np.datetime64(pd.Timestamp(end_date).floor('D') + pd.Timedelta(days=1), 'ns'),
+                         side='left')
+    rows = table.iloc[lo:hi]
+    rows = rows[rows['field'].isin(fields)]
+    if receivers:
+        rows = rows[rows['Receiver'].isin(receivers)]
+    # Days since the start of the range, the sketch sums are relative to each day
+    days = ((rows['bucket'] - start_date) / pd.Timedelta(days=1)).to_numpy()
+    count = rows['count'].to_numpy(dtype='float64')
+    sumf, sumff, sumx, sumfx = (rows[column].to_numpy(dtype='float64') for column in ['sumf', 'sumff', 'sumx', 'sumfx'])
+    points = rows[rollups.sketch_columns].to_numpy(dtype='float64')
+    valid = ~np.isnan(points)
+    # Every point of a day stands for the same share of its observations
+    weights = np.broadcast_to((count / np.maximum(valid.sum(axis=1), 1))[:, None], points.shape)
+    result = []
+    for (receiver, field), index in sorted(rows.groupby(['Receiver', 'field']).indices.items()):
+        n = count[index].sum()
+        sumt = (count[index] * days[index] + sumf[index]).sum()
+        sumtt = (count[index] * days[index] ** 2 + 2 * days[index] * sumf[index] + sumff[index]).sum()
+        sumtx = (days[index] * sumx[index] + sumfx[index]).sum()
+        median, mad, clipped, outliers = point_stats(points[index][valid[index]], weights[index][valid[index]])
+        result.append([receiver, field, int(n), sumx[index].sum() / n, median, mad, clipped, int(round(outliers)),
+                       drift(n, sumt, sumtt, sumx[index].sum(), sumtx)])
+    return pd.DataFrame(result, columns=columns)
+
+
+def from_df(df, fields):
+    # Exact statistics of the loaded observations
+    result = []
+    if df.empty or 'DateTime' not in df.columns:
+        return pd.DataFrame(result, columns=columns)
+    days = ((df['DateTime'] - df['DateTime'].min().floor('D')) / pd.Timedelta(days=1)).to_numpy()
+    receivers = df['Receiver'].astype(str) if 'Receiver' in df.columns else pd.Series('', index=df.index)
+    for receiver, index in sorted(receivers.groupby(receivers).indices.items()):
+        for field in fields:
+            if (field not in df.columns or not pd.api.types.is_numeric_dtype(df[field]) or
+                    pd.api.types.is_bool_dtype(df[field])):
+                continue
+            x = df[field].to_numpy(dtype='float64', na_value=np.nan)[index]
+            t = days[index]
+            valid = np.isfinite(x) & np.isfinite(t)
+            x, t = x[valid], t[valid]
+            if len(x) == 0:
+                continue
+            median, mad, clipped, outliers = point_stats(x, np.ones(len(x)))
+            result.append([receiver, field, len(x), x.mean(), median, mad, clipped, int(outliers),
+                           drift(len(x), t.sum(), (t * t).sum(), x.sum(), (t * x).sum())])
+    return pd.DataFrame(result, columns=columns).sort_values(by=['Receiver', 'field'], ignore_index=True)
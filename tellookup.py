@@ -0,0 +1,206 @@
+# Persisted ObsNum -> telescope position lookup built from the tel files.
+# The lookup keeps the first tel row of every ObsNum with the demanded Az/El positions
+# already converted to degrees, sorted by ObsNum so joins are a searchsorted.
+# It is extended as tel files are indexed and records how far it has consumed every
+# file, so a tel CSV is parsed once and never on the request path. Files are parsed in
+# blocks keeping only tel_columns, and a file still being written is only read from
+# the end of the last complete line consumed before.
+import csv
+import io
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+import config
+
+tel_columns = ['ObsNum', 'Telescope_AzDesPos', 'Telescope_ElDesPos']
+lookup_filename = 'tel_lookup.npz'
+consumed_filename = 'tel_lookup.json'
+
+lock = threading.Lock()
+# keys, az and el arrays of the lookup plus the mtime of the file they came from
+lookup = {'keys': np.array([], dtype='int64'), 'az': np.array([]), 'el': np.array([]), 'mtime_ns': None}
+# filename -> mtime_ns, size, offset and header consumed plus rows and ObsNum range read
+consumed = {}
+# Rows read by read_new() that update() has not added to the lookup yet, and whether
+# consumed changed since it was saved
+pending = {'parts': [], 'changed': False}
+
+
+def lookup_path():
+    return os.path.join(config.cache_dir, lookup_filename)
+
+
+def consumed_path():
+    return os.path.join(config.cache_dir, consumed_filename)
+
+
+def load():
+    # Reload when the persisted lookup was replaced, possibly by another process
+    global consumed
+    path = lookup_path()
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime_ns == lookup['mtime_ns']:
+        return
+    try:
+        with np.load(path) as data:
+            lookup.update(keys=data['keys'], az=data['az'], el=data['el'], mtime_ns=mtime_ns)
+        with open(consumed_path()) as f:
+            consumed = json.load(f)
+    except Exception as e:
+        print(f"Error reading tel lookup {path}: {e}")
+
+
+def parse_block(data, columns):
+    df = pd.read_csv(io.BytesIO(data), header=None, names=columns, usecols=tel_columns)
+    df = df[df['ObsNum'].notna()]
+    return df.astype({'ObsNum': 'int64'})
+
+
+def read_rows(f, state, end):
+    # Parse the complete lines of f between state['offset'] and end, one block of
+    # config.tel_block_bytes at a time, and advance state past them
+    f.seek(state['offset'])
+    parts = []
+    rest = b''
+    remaining = end - state['offset']
+    while remaining > 0:
+        block = f.read(min(config.tel_block_bytes, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        rest = block[cut:]
+        if cut == 0:
+            continue
+        df = parse_block(block[:cut], state['columns'])
+        state['offset'] += cut
+        if df.empty:
+            continue
+        state['rows'] += len(df)
+        obsnum_min, obsnum_max = int(df['ObsNum'].min()), int(df['ObsNum'].max())
+        state['obsnum_min'] = obsnum_min if state['obsnum_min'] is None else min(state['obsnum_min'], obsnum_min)
+        state['obsnum_max'] = obsnum_max if state['obsnum_max'] is None else max(state['obsnum_max'], obsnum_max)
+        parts.append(df.drop_duplicates(subset='ObsNum', keep='first'))
+    return parts
+
+
+def read_new(folder_path, filename):
+    # Read what was appended to a tel file since it was last consumed and return its
+    # summary for the index. A file that shrank or whose header changed is read again
+    path = os.path.join(folder_path, filename)
+    with lock:
+        load()
+        state = consumed.get(filename)
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        header = f.readline()
+        if isinstance(state, dict) and state['mtime_ns'] == stat.st_mtime_ns and state['size'] == stat.st_size:
+            return summary(state)
+        if (not isinstance(state, dict) or stat.st_size < state['offset'] or
+                header.decode(errors='replace') != state['header']):
+            state = {'offset': len(header), 'header': header.decode(errors='replace'), 'rows': 0,
+                     'obsnum_min': None, 'obsnum_max': None}
+            state['columns'] = next(csv.reader([state['header'].strip()]), [])
+        else:
+            state = dict(state)
+        state.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        parts = []
+        if not header.endswith(b'\n'):
+            # Not even the header was written completely
+            state['offset'] = 0
+        elif all(column in state['columns'] for column in tel_columns):
+            parts = read_rows(f, state, stat.st_size)
+        elif state['offset'] == len(header):
+            print(f"Required columns not found in {filename}: {tel_columns}")
+            state['offset'] = stat.st_size
+    with lock:
+        consumed[filename] = state
+        pending['parts'] += [(filename, part) for part in parts]
+        pending['changed'] = True
+    return summary(state)
+
+
+def summary(state):
+    return {'obsnum_min': state['obsnum_min'], 'obsnum_max': state['obsnum_max'], 'rows': state['rows'],
+            'mtime_ns': state['mtime_ns'], 'size': state['size'], 'receivers': ''}
+
+
+def update(folder_path, index_df):
+    # Add the rows read since the last update, reading the files of index_df that were
+    # not consumed yet or changed since, which the indexer normally did already. True
+    # when ObsNums were added, rows of ObsNums already known leave the lookup as it is
+    with lock:
+        load()
+        states = dict(consumed)
+    index_df = index_df[index_df['mtime_ns'].notna()]
+    for filename, mtime_ns, size in zip(index_df['filename'].tolist(), index_df['mtime_ns'].tolist(),
+                                        index_df['size'].tolist()):
+        state = states.get(filename)
+        if not isinstance(state, dict) or state['mtime_ns'] != mtime_ns or state['size'] != size:
+            try:
+                read_new(folder_path, filename)
+            except OSError as e:
+                print(f"Error reading tel file {filename}: {e}")
+    with lock:
+        parts = pending['parts']
+        if not parts and not pending['changed']:
+            return False
+        pending.update(parts=[], changed=False)
+        n_keys = len(lookup['keys'])
+        if parts:
+            # In file order, which decides the first row of an ObsNum
+            parts = [part for filename, part in sorted(parts, key=lambda item: item[0])]
+            current = pd.DataFrame({'ObsNum': lookup['keys'], 'Telescope_AzDesPos': lookup['az'],
+                                    'Telescope_ElDesPos': lookup['el']})
+            new = pd.concat(parts, ignore_index=True)
+            new['Telescope_AzDesPos'] = new['Telescope_AzDesPos']*180/3.14159
+            new['Telescope_ElDesPos'] = new['Telescope_ElDesPos']*180/3.14159
+            merged = pd.concat([current, new], ignore_index=True) if not current.empty else new
+            merged = merged.drop_duplicates(subset='ObsNum', keep='first').sort_values(by='ObsNum')
+            lookup.update(keys=merged['ObsNum'].to_numpy(dtype='int64'),
+                          az=merged['Telescope_AzDesPos'].to_numpy(dtype='float64'),
+                          el=merged['Telescope_ElDesPos'].to_numpy(dtype='float64'))
+        if len(lookup['keys']) == n_keys:
+            save_consumed()
+            return False
+        save()
+        return True
+
+
+def save_consumed():
+    os.makedirs(config.cache_dir, exist_ok=True)
+    tmp_consumed_path = f'{consumed_path()}.{os.getpid()}.tmp'
+    with open(tmp_consumed_path, 'w') as f:
+        json.dump(consumed, f)
+    os.replace(tmp_consumed_path, consumed_path())
+
+
+def save():
+    path = lookup_path()
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    save_consumed()
+    np.savez(tmp_path, keys=lookup['keys'], az=lookup['az'], el=lookup['el'])
+    os.replace(tmp_path, path)
+    lookup['mtime_ns'] = os.stat(path).st_mtime_ns
+
+
+def join(df_main):
+    # Inner join of df_main with the lookup on ObsNum, keeping the order of df_main
+    with lock:
+        load()
+        keys, az, el = lookup['keys'], lookup['az'], lookup['el']
+    if len(keys) == 0 or df_main.empty:
+        return pd.DataFrame()
+    obsnum = df_main['ObsNum'].to_numpy()
+    pos = np.searchsorted(keys, obsnum).clip(max=len(keys) - 1)
+    found = keys[pos] == obsnum
+    df = df_main[found].reset_index(drop=True)
+    df['Telescope_AzDesPos'] = az[pos[found]]
+    df['Telescope_ElDesPos'] = el[pos[found]]
+    return df